@@ -1,73 +1,99 @@
-from functools import lru_cache
-import asyncio
-from contextlib import asynccontextmanager
 from mem0 import Memory
 from config.neo4j_config import Neo4jConfig
 from config.mem0_setting import Mem0Setting
 from config.embedding import Embedding
 from config.llm import LLM
 from core.memory_service import MemoryService
+from core.memory_batch_writer import MemoryBatchWriter
+from core.storage.ann_index import ANNIndex
+from core.storage.embedding_cache import CachedEmbedder
+from core.storage.redis_cache import get_embedding_cache, get_version_store, close_caches
 from core.agent import MemoryAgent
+import asyncio
 import logging
 
-# 全局实例缓存
-_instances = {}
-_locks = {}
+# 全局实例（在应用启动时通过 init_instances 一次性创建）
+MEMORY: Memory | None = None
+LLM_CONFIG: LLM | None = None
+AGENT: MemoryAgent | None = None
+MEMORY_SERVICE: MemoryService | None = None
+BATCH_WRITER: MemoryBatchWriter | None = None
+ANN_INDEX: ANNIndex | None = None
+
+# 初始化锁，防止并发冷启动时重复创建昂贵的Memory实例
+_init_lock = asyncio.Lock()
 
-@asynccontextmanager
-async def get_instance_lock(key: str):
-    """获取实例锁"""
-    if key not in _locks:
-        _locks[key] = asyncio.Lock()
-    async with _locks[key]:
-        yield
+async def init_instances():
+    """在应用启动时创建所有实例（可重复调用，只初始化一次）"""
+    if MEMORY_SERVICE is not None:
+        return
+    async with _init_lock:
+        if MEMORY_SERVICE is not None:
+            return
+        _create_instances()
+        BATCH_WRITER.start()
+
+def _create_instances():
+    """创建所有实例"""
+    global MEMORY, LLM_CONFIG, AGENT, MEMORY_SERVICE, BATCH_WRITER, ANN_INDEX
+    try:
+        LLM_CONFIG = LLM.from_env()
+        embedding = Embedding.from_env()
+        # 暂时禁用Neo4j图数据库功能进行测试
+        azure_setting = Mem0Setting(LLM_CONFIG, embedding, False, None)
+        mem0_config = azure_setting.get_mem0_config()
+        MEMORY = Memory.from_config(mem0_config)
+        # 缓存查询向量，mem0检索和ANN检索共用（CACHE_BACKEND=redis 时跨进程共享）
+        MEMORY.embedding_model = CachedEmbedder(MEMORY.embedding_model, remote=get_embedding_cache())
+        logging.info("Memory实例创建成功")
+    except Exception as e:
+        logging.error(f"创建Memory实例失败: {e}")
+        raise
+    # 进程内ANN索引，由Agent和记忆服务共享
+    ANN_INDEX = ANNIndex(MEMORY, versions=get_version_store())
+    AGENT = MemoryAgent(MEMORY, LLM_CONFIG, ANN_INDEX)
+    logging.info("MemoryAgent实例创建成功")
+    MEMORY_SERVICE = MemoryService(MEMORY, ANN_INDEX)
+    BATCH_WRITER = MemoryBatchWriter(MEMORY, ann_index=ANN_INDEX)
 
-@lru_cache()
 def get_memory_instance() -> Memory:
-    """获取单例的Memory实例（优化版）"""
-    if 'memory' not in _instances:
-        try:
-            llm = LLM()
-            embedding = Embedding()
-            # 暂时禁用Neo4j图数据库功能进行测试
-            azure_setting = Mem0Setting(llm, embedding, False, None)
-            mem0_config = azure_setting.get_mem0_config()
-            _instances['memory'] = Memory.from_config(mem0_config)
-            logging.info("Memory实例创建成功")
-        except Exception as e:
-            logging.error(f"创建Memory实例失败: {e}")
-            raise
-    return _instances['memory']
+    """获取单例的Memory实例（需在应用启动后调用）"""
+    return MEMORY
 
-@lru_cache()
 def get_llm_instance() -> LLM:
-    """获取LLM实例"""
-    if 'llm' not in _instances:
-        _instances['llm'] = LLM()
-    return _instances['llm']
+    """获取LLM实例（需在应用启动后调用）"""
+    return LLM_CONFIG
 
+# 以下依赖保持 async def：FastAPI 会在事件循环中直接 await 异步依赖，
+# 而普通 def 依赖会被调度到线程池执行，开销反而更大
 async def get_memory_agent() -> MemoryAgent:
-    """获取记忆Agent实例（异步版本）"""
-    async with get_instance_lock('agent'):
-        if 'agent' not in _instances:
-            memory = get_memory_instance()
-            llm = get_llm_instance()
-            _instances['agent'] = MemoryAgent(memory, llm)
-            logging.info("MemoryAgent实例创建成功")
-    return _instances['agent']
+    """获取记忆Agent实例"""
+    if AGENT is None:
+        await init_instances()
+    return AGENT
 
-@lru_cache()
-def get_memory_service() -> MemoryService:
+async def get_memory_service() -> MemoryService:
     """获取记忆服务实例"""
-    if 'memory_service' not in _instances:
-        memory = get_memory_instance()
-        _instances['memory_service'] = MemoryService(memory)
-    return _instances['memory_service']
+    if MEMORY_SERVICE is None:
+        await init_instances()
+    return MEMORY_SERVICE
+
+async def get_batch_writer() -> MemoryBatchWriter:
+    """获取批量记忆写入器"""
+    if BATCH_WRITER is None:
+        await init_instances()
+    return BATCH_WRITER
 
 # 清理函数
 async def cleanup_instances():
     """清理所有实例"""
-    if 'agent' in _instances:
-        await _instances['agent'].close()
-    _instances.clear()
-    logging.info("所有实例已清理")
\ No newline at end of file
+    global MEMORY, LLM_CONFIG, AGENT, MEMORY_SERVICE, BATCH_WRITER, ANN_INDEX
+    if BATCH_WRITER is not None:
+        await BATCH_WRITER.stop()
+    if AGENT is not None:
+        await AGENT.close()
+    if ANN_INDEX is not None:
+        ANN_INDEX.close()
+    await close_caches()
+    MEMORY = LLM_CONFIG = AGENT = MEMORY_SERVICE = BATCH_WRITER = ANN_INDEX = None
+    logging.info("所有实例已清理")
@@ -1,63 +1,67 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 from typing import List, Optional, Dict, Any
 from datetime import datetime
 
-class ChatMessage(BaseModel):
+class FrozenModel(BaseModel):
+    """API模型基类：不可变，忽略未知字段"""
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
+class ChatMessage(FrozenModel):
     role: str  # "user" or "assistant"
     content: str
     timestamp: Optional[datetime] = None
 
-class ChatRequest(BaseModel):
+class ChatRequest(FrozenModel):
     user_id: str
     message: str
     session_id: Optional[str] = None
     metadata: Optional[Dict[str, Any]] = None
     stream: Optional[bool] = False  # 是否使用流式输出
 
-class ChatResponse(BaseModel):
+class ChatResponse(FrozenModel):
     response: str
     user_id: str
     session_id: str
     memories_used: List[str] = []
     timestamp: datetime
 
-class MemorySearchRequest(BaseModel):
+class MemorySearchRequest(FrozenModel):
     user_id: str
     query: str
     limit: Optional[int] = 10
 
-class MemorySearchResponse(BaseModel):
+class MemorySearchResponse(FrozenModel):
     memories: List[Dict[str, Any]]
     total_count: int
 
-class ConversationHistoryRequest(BaseModel):
+class ConversationHistoryRequest(FrozenModel):
     user_id: str
     session_id: Optional[str] = None
     limit: Optional[int] = 50
 
 # 新增记忆管理相关模型
-class AddMemoryRequest(BaseModel):
+class AddMemoryRequest(FrozenModel):
     user_id: str
     content: str
     note_id: Optional[str] = None  # 关联的笔记ID
     metadata: Optional[Dict[str, Any]] = None
 
-class BatchAddMemoryRequest(BaseModel):
+class BatchAddMemoryRequest(FrozenModel):
     user_id: str
     memories: List[Dict[str, Any]]
 
-class UpdateMemoryRequest(BaseModel):
+class UpdateMemoryRequest(FrozenModel):
     memory_id: str
     content: str
     metadata: Optional[Dict[str, Any]] = None
 
-class MemoryResponse(BaseModel):
+class MemoryResponse(FrozenModel):
     success: bool
     message: str
     data: Optional[Dict[str, Any]] = None
     timestamp: datetime
 
-class MemoryStatsResponse(BaseModel):
+class MemoryStatsResponse(FrozenModel):
     user_id: str
     total_memories: int
     date_distribution: Dict[str, int]
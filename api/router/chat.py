@@ -1,6 +1,6 @@
 from fastapi import APIRouter, Depends, HTTPException
-from fastapi.responses import StreamingResponse
-from typing import List
+from fastapi.responses import Response, StreamingResponse, ORJSONResponse
+from typing import List, Dict, Any, AsyncIterator
 from mem0 import Memory
 from config.llm import LLM
 from api.dependencies import get_memory_agent  # 使用异步版本
@@ -9,59 +9,78 @@ from api.models import (
     ConversationHistoryRequest
 )
 from core.agent import MemoryAgent
-from datetime import datetime
-import json
+import orjson
+import msgspec
 import asyncio
 
-router = APIRouter(prefix="/chat", tags=["chat"])
+router = APIRouter(prefix="/chat", tags=["chat"], default_response_class=ORJSONResponse)
 
-@router.post("/message")
+# 预先序列化的流式结束标记
+_DONE_FRAME = b"data: " + orjson.dumps({"type": "done"}) + b"\n\n"
+
+# 预先序列化的健康检查响应体
+_HEALTH_BODY = orjson.dumps({"status": "healthy"})
+
+# 流式响应头
+_SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive"
+}
+
+class _ContentFrame(msgspec.Struct, tag_field="type", tag="content"):
+    """流式内容帧，编码为 {"type": "content", "content": ...}"""
+    content: str
+
+async def _sse_stream(result: Dict[str, Any]) -> AsyncIterator[bytes]:
+    """将agent的流式结果转换为SSE数据帧"""
+    # 首先发送元数据
+    metadata_chunk = {
+        "type": "metadata",
+        "user_id": result["user_id"],
+        "session_id": result["session_id"],
+        "memories_used": result["memories_used"],
+        "timestamp": result["timestamp"]
+    }
+    yield b"data: " + orjson.dumps(metadata_chunk) + b"\n\n"
+    
+    # 然后发送流式内容（复用同一个编码器）
+    encoder = msgspec.json.Encoder()
+    async for chunk in result["response_generator"]:
+        if chunk:
+            yield b"data: " + encoder.encode(_ContentFrame(chunk)) + b"\n\n"
+    
+    # 发送结束标记
+    yield _DONE_FRAME
+
+def _chat_response(result: Dict[str, Any]) -> ORJSONResponse:
+    """直接序列化agent返回的结果，跳过ChatResponse校验"""
+    return ORJSONResponse({
+        "response": result["response"],
+        "user_id": result["user_id"],
+        "session_id": result["session_id"],
+        "memories_used": result["memories_used"],
+        "timestamp": result["timestamp"]
+    })
+
+@router.post("/message", response_model=ChatResponse, response_model_exclude_defaults=True, response_class=ORJSONResponse)
 async def send_message(request: ChatRequest, agent: MemoryAgent = Depends(get_memory_agent)):
     """发送消息并获取AI回复，支持流式输出"""
     try:
         # 如果请求流式输出
         if request.stream:
-            stream_metadata = request.metadata.copy() if request.metadata else {}
-            stream_metadata['stream'] = True
-            
             result = await agent.chat(
                 user_id=request.user_id,
                 message=request.message,
                 session_id=request.session_id,
-                metadata=stream_metadata
+                metadata=request.metadata,
+                stream=True
             )
             
             if result.get('stream'):
-                async def generate():
-                    # 首先发送元数据
-                    metadata_chunk = {
-                        "type": "metadata",
-                        "user_id": result["user_id"],
-                        "session_id": result["session_id"],
-                        "memories_used": result["memories_used"],
-                        "timestamp": result["timestamp"].isoformat()
-                    }
-                    yield f"data: {json.dumps(metadata_chunk)}\n\n"
-                    
-                    # 然后发送流式内容
-                    async for chunk in result["response_generator"]:
-                        if chunk:
-                            chunk_data = {
-                                "type": "content",
-                                "content": chunk
-                            }
-                            yield f"data: {json.dumps(chunk_data)}\n\n"
-                    
-                    # 发送结束标记
-                    yield f"data: {json.dumps({'type': 'done'})}\n\n"
-                
                 return StreamingResponse(
-                    generate(),
-                    media_type="text/plain",
-                    headers={
-                        "Cache-Control": "no-cache",
-                        "Connection": "keep-alive"
-                    }
+                    _sse_stream(result),
+                    media_type="text/event-stream",
+                    headers=_SSE_HEADERS
                 )
         
         # 普通模式
@@ -72,17 +91,11 @@ async def send_message(request: ChatRequest, agent: MemoryAgent = Depends(get_me
             metadata=request.metadata
         )
         
-        return ChatResponse(
-            response=result["response"],
-            user_id=result["user_id"],
-            session_id=result["session_id"],
-            memories_used=result["memories_used"],
-            timestamp=result["timestamp"]
-        )
+        return _chat_response(result)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"处理消息时出错: {str(e)}")
 
-@router.post("/search-memories", response_model=MemorySearchResponse)
+@router.post("/search-memories", response_model=MemorySearchResponse, response_model_exclude_none=True)
 async def search_memories(request: MemorySearchRequest, agent: MemoryAgent = Depends(get_memory_agent)):
     """搜索用户记忆"""
     try:
@@ -131,62 +144,27 @@ async def clear_user_memories(user_id: str, agent: MemoryAgent = Depends(get_mem
 async def stream_message(request: ChatRequest, agent: MemoryAgent = Depends(get_memory_agent)):
     """流式输出对话"""
     try:
-        # 设置流式模式
-        stream_metadata = request.metadata.copy() if request.metadata else {}
-        stream_metadata['stream'] = True
-        
         result = await agent.chat(
             user_id=request.user_id,
             message=request.message,
             session_id=request.session_id,
-            metadata=stream_metadata
+            metadata=request.metadata,
+            stream=True
         )
         
         if result.get('stream'):
-            async def generate():
-                # 首先发送元数据
-                metadata_chunk = {
-                    "type": "metadata",
-                    "user_id": result["user_id"],
-                    "session_id": result["session_id"],
-                    "memories_used": result["memories_used"],
-                    "timestamp": result["timestamp"].isoformat()
-                }
-                yield f"data: {json.dumps(metadata_chunk)}\n\n"
-                
-                # 然后发送流式内容
-                async for chunk in result["response_generator"]:
-                    if chunk:
-                        chunk_data = {
-                            "type": "content",
-                            "content": chunk
-                        }
-                        yield f"data: {json.dumps(chunk_data)}\n\n"
-                
-                # 发送结束标记
-                yield f"data: {json.dumps({'type': 'done'})}\n\n"
-            
             return StreamingResponse(
-                generate(),
-                media_type="text/plain",
-                headers={
-                    "Cache-Control": "no-cache",
-                    "Connection": "keep-alive"
-                }
+                _sse_stream(result),
+                media_type="text/event-stream",
+                headers=_SSE_HEADERS
             )
         else:
             # 如果不支持流式，返回普通响应
-            return ChatResponse(
-                response=result["response"],
-                user_id=result["user_id"],
-                session_id=result["session_id"],
-                memories_used=result["memories_used"],
-                timestamp=result["timestamp"]
-            )
+            return _chat_response(result)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"流式对话时出错: {str(e)}")
 
 @router.get("/health")
 async def health_check():
     """健康检查"""
-    return {"status": "healthy", "timestamp": datetime.now()}
\ No newline at end of file
+    return Response(content=_HEALTH_BODY, media_type="application/json")
\ No newline at end of file
@@ -1,112 +1,133 @@
 from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import Response, ORJSONResponse
 from typing import List
 from core.memory_service import MemoryService
-from api.dependencies import get_memory_service
+from core.memory_batch_writer import MemoryBatchWriter
+from core.agent import MemoryAgent
+from api.dependencies import get_memory_service, get_batch_writer, get_memory_agent
 from api.models import (
     AddMemoryRequest, BatchAddMemoryRequest, UpdateMemoryRequest,
     MemorySearchRequest, MemoryResponse, MemoryStatsResponse
 )
-from datetime import datetime
+from utils import clock
+from anyio import to_thread, CapacityLimiter
+import orjson
 
 router = APIRouter(prefix="/memory", tags=["memory"])
 
-@router.post("/add", response_model=MemoryResponse)
-async def add_memory(request: AddMemoryRequest, service: MemoryService = Depends(get_memory_service)):
+# 预先序列化的健康检查响应体
+_HEALTH_BODY = orjson.dumps({"status": "healthy", "service": "memory"})
+
+# 限制同时执行的阻塞记忆操作（Chroma/Azure调用）数量
+_IO_LIMITER = CapacityLimiter(32)
+
+@router.post("/add")
+async def add_memory(request: AddMemoryRequest, service: MemoryService = Depends(get_memory_service), agent: MemoryAgent = Depends(get_memory_agent)):
     """添加单个记忆"""
-    result = service.add_memory(request.content, request.user_id, request.metadata)
+    result = await to_thread.run_sync(service.add_memory, request.content, request.user_id, request.metadata, limiter=_IO_LIMITER)
+    if result["success"]:
+        await agent.invalidate_memory_cache(request.user_id)
     
-    return MemoryResponse(
-        success=result["success"],
-        message=result["message"],
-        data=result,
-        timestamp=datetime.now()
-    )
+    return ORJSONResponse({
+        "success": result["success"],
+        "message": result["message"],
+        "data": result,
+        "timestamp": clock.now()
+    })
 
-@router.post("/batch-add", response_model=MemoryResponse)
-async def batch_add_memories(request: BatchAddMemoryRequest, service: MemoryService = Depends(get_memory_service)):
-    """批量添加记忆"""
-    result = service.batch_add_memories(request.memories, request.user_id)
+@router.post("/batch-add")
+async def batch_add_memories(request: BatchAddMemoryRequest, writer: MemoryBatchWriter = Depends(get_batch_writer), agent: MemoryAgent = Depends(get_memory_agent)):
+    """批量添加记忆（与并发请求合并写入）"""
+    result = await writer.submit(request.memories, request.user_id)
+    if result["success_count"]:
+        await agent.invalidate_memory_cache(request.user_id)
     
-    return MemoryResponse(
-        success=result["success"],
-        message=result["message"],
-        data=result,
-        timestamp=datetime.now()
-    )
+    return ORJSONResponse({
+        "success": result["success"],
+        "message": result["message"],
+        "data": result,
+        "timestamp": clock.now()
+    })
 
-@router.post("/search", response_model=MemoryResponse)
+@router.post("/search")
 async def search_memories(request: MemorySearchRequest, service: MemoryService = Depends(get_memory_service)):
     """搜索记忆"""
-    result = service.search_memories(request.query, request.user_id, request.limit)
+    result = await to_thread.run_sync(service.search_memories, request.query, request.user_id, request.limit, limiter=_IO_LIMITER)
     
-    return MemoryResponse(
-        success=result["success"],
-        message=result["message"],
-        data=result,
-        timestamp=datetime.now()
-    )
+    return ORJSONResponse({
+        "success": result["success"],
+        "message": result["message"],
+        "data": result,
+        "timestamp": clock.now()
+    })
 
-@router.get("/user/{user_id}", response_model=MemoryResponse)
+@router.get("/user/{user_id}", response_model=MemoryResponse, response_model_exclude_none=True)
 async def get_user_memories(user_id: str, service: MemoryService = Depends(get_memory_service)):
     """获取用户所有记忆"""
-    result = service.get_all_memories(user_id)
+    result = await to_thread.run_sync(service.get_all_memories, user_id, limiter=_IO_LIMITER)
     
     return MemoryResponse(
         success=result["success"],
         message=result["message"],
         data=result,
-        timestamp=datetime.now()
+        timestamp=clock.now()
     )
 
-@router.delete("/memory/{memory_id}", response_model=MemoryResponse)
-async def delete_memory(memory_id: str, service: MemoryService = Depends(get_memory_service)):
+@router.delete("/memory/{memory_id}", response_model=MemoryResponse, response_model_exclude_none=True)
+async def delete_memory(memory_id: str, service: MemoryService = Depends(get_memory_service), agent: MemoryAgent = Depends(get_memory_agent)):
     """删除指定记忆"""
-    result = service.delete_memory(memory_id)
+    result = await to_thread.run_sync(service.delete_memory, memory_id, limiter=_IO_LIMITER)
+    if result["success"] and result.get("user_id"):
+        await agent.invalidate_memory_cache(result["user_id"])
     
     return MemoryResponse(
         success=result["success"],
         message=result["message"],
         data=result,
-        timestamp=datetime.now()
+        timestamp=clock.now()
     )
 
-@router.delete("/user/{user_id}", response_model=MemoryResponse)
-async def delete_user_memories(user_id: str, service: MemoryService = Depends(get_memory_service)):
+@router.delete("/user/{user_id}", response_model=MemoryResponse, response_model_exclude_none=True)
+async def delete_user_memories(user_id: str, service: MemoryService = Depends(get_memory_service), agent: MemoryAgent = Depends(get_memory_agent)):
     """删除用户所有记忆"""
-    result = service.delete_user_memories(user_id)
+    result = await to_thread.run_sync(service.delete_user_memories, user_id, limiter=_IO_LIMITER)
+    if result["success"]:
+        await agent.invalidate_memory_cache(user_id)
     
     return MemoryResponse(
         success=result["success"],
         message=result["message"],
         data=result,
-        timestamp=datetime.now()
+        timestamp=clock.now()
     )
 
-@router.put("/update", response_model=MemoryResponse)
-async def update_memory(request: UpdateMemoryRequest, service: MemoryService = Depends(get_memory_service)):
+@router.put("/update", response_model=MemoryResponse, response_model_exclude_none=True)
+async def update_memory(request: UpdateMemoryRequest, service: MemoryService = Depends(get_memory_service), agent: MemoryAgent = Depends(get_memory_agent)):
     """更新记忆"""
-    result = service.update_memory(request.memory_id, request.content, request.metadata)
+    result = await to_thread.run_sync(service.update_memory, request.memory_id, request.content, request.metadata, limiter=_IO_LIMITER)
+    if result["success"] and result.get("user_id"):
+        await agent.invalidate_memory_cache(result["user_id"])
     
     return MemoryResponse(
         success=result["success"],
         message=result["message"],
         data=result,
-        timestamp=datetime.now()
+        timestamp=clock.now()
     )
 
-@router.get("/stats/{user_id}", response_model=MemoryResponse)
+@router.get("/stats/{user_id}", response_model=MemoryResponse, response_model_exclude_none=True)
 async def get_memory_stats(user_id: str, service: MemoryService = Depends(get_memory_service)):
     """获取用户记忆统计信息"""
-    result = service.get_memory_stats(user_id)
+    result = await to_thread.run_sync(service.get_memory_stats, user_id, limiter=_IO_LIMITER)
     
     return MemoryResponse(
         success=result["success"],
         message="统计信息获取成功" if result["success"] else result.get("message", "获取失败"),
         data=result,
-        timestamp=datetime.now()
+        timestamp=clock.now()
     )
 
 @router.get("/health")
 async def memory_health_check():
     """记忆服务健康检查"""
-    return {"status": "healthy", "service": "memory", "timestamp": datetime.now()}
\ No newline at end of file
+    return Response(content=_HEALTH_BODY, media_type="application/json")
\ No newline at end of file
@@ -0,0 +1,4 @@
+from dotenv import load_dotenv
+
+# 统一加载环境变量（仅在首次导入config包时执行一次）
+load_dotenv()
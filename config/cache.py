@@ -0,0 +1,19 @@
+from dataclasses import dataclass
+import functools
+import os
+
+
+@dataclass(frozen=True, slots=True)
+class CacheConfig:
+    """缓存后端配置（memory：进程内缓存；redis：多进程共享缓存）"""
+    backend: str
+    redis_url: str
+
+    @classmethod
+    @functools.cache
+    def from_env(cls) -> "CacheConfig":
+        """从环境变量读取缓存配置（只读取一次）"""
+        return cls(
+            backend=os.getenv("CACHE_BACKEND", "memory").lower(),
+            redis_url=os.getenv("REDIS_URL", "redis://localhost:6379"),
+        )
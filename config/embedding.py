@@ -1,11 +1,21 @@
-from dotenv import load_dotenv
+from dataclasses import dataclass
+import functools
 import os
 
-load_dotenv()
-
+@dataclass(frozen=True, slots=True)
 class Embedding:
-    def __init__(self):
-        self.endpoint = os.getenv("AZURE_EMBEDDING_ENDPOINT", os.getenv("AZURE_OPENAI_ENDPOINT"))
-        self.api_key = os.getenv("AZURE_EMBEDDING_API_KEY", os.getenv("AZURE_OPENAI_API_KEY"))
-        self.api_version = os.getenv("AZURE_EMBEDDING_API_VERSION", "2023-05-15")
-        self.deployment_name = os.getenv("AZURE_EMBEDDING_DEPLOYMENT", "text-embedding-3-small")
+    endpoint: str | None
+    api_key: str | None
+    api_version: str | None
+    deployment_name: str | None
+
+    @classmethod
+    @functools.cache
+    def from_env(cls) -> "Embedding":
+        """从环境变量读取嵌入模型配置（只读取一次）"""
+        return cls(
+            endpoint=os.getenv("AZURE_EMBEDDING_ENDPOINT", os.getenv("AZURE_OPENAI_ENDPOINT")),
+            api_key=os.getenv("AZURE_EMBEDDING_API_KEY", os.getenv("AZURE_OPENAI_API_KEY")),
+            api_version=os.getenv("AZURE_EMBEDDING_API_VERSION", "2023-05-15"),
+            deployment_name=os.getenv("AZURE_EMBEDDING_DEPLOYMENT", "text-embedding-3-small"),
+        )
@@ -1,14 +1,33 @@
-from dotenv import load_dotenv
+from dataclasses import dataclass
+import functools
 import os
 
-# 加载环境变量
-load_dotenv()
-
 # Azure LLM类 获取到可能用到的api
+@dataclass(frozen=True, slots=True)
 class LLM:
-    def __init__(self):
-        self.api_key = os.getenv("AZURE_OPENAI_API_KEY")
-        self.endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
-        self.deployment = os.getenv("AZURE_OPENAI_DEPLOYMENT")
-        self.model = os.getenv("AZURE_OPENAI_DEPLOYMENT")  # 添加model属性
-        self.api_version = os.getenv("AZURE_OPENAI_API_VERSION", "2025-01-01-preview")
\ No newline at end of file
+    api_key: str | None
+    endpoint: str | None
+    deployment: str | None
+    model: str | None
+    api_version: str | None
+    max_concurrency: int = 10
+    rpm: int | None = None
+    tpm: int | None = None
+    max_completion_tokens: int = 2000
+
+    @classmethod
+    @functools.cache
+    def from_env(cls) -> "LLM":
+        """从环境变量读取LLM配置（只读取一次）"""
+        return cls(
+            api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+            endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+            deployment=os.getenv("AZURE_OPENAI_DEPLOYMENT"),
+            model=os.getenv("AZURE_OPENAI_DEPLOYMENT"),  # 添加model属性
+            api_version=os.getenv("AZURE_OPENAI_API_VERSION", "2025-01-01-preview"),
+            # 并发与限流配置（RPM/TPM 未设置时不限流）
+            max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", "10")),
+            rpm=int(os.getenv("LLM_RPM")) if os.getenv("LLM_RPM") else None,
+            tpm=int(os.getenv("LLM_TPM")) if os.getenv("LLM_TPM") else None,
+            max_completion_tokens=int(os.getenv("LLM_MAX_COMPLETION_TOKENS", "2000")),
+        )
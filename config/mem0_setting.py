@@ -1,7 +1,39 @@
 from .llm import LLM
 from .embedding import Embedding
 from .neo4j_config import Neo4jConfig
-from langchain_openai import AzureChatOpenAI
+from types import MappingProxyType
+from typing import TYPE_CHECKING, Any, Mapping
+import functools
+
+if TYPE_CHECKING:
+    from langchain_openai import AzureChatOpenAI
+
+
+@functools.cache
+def _build_azure_llm(endpoint: str, deployment: str, api_key: str, api_version: str, max_completion_tokens: int) -> "AzureChatOpenAI":
+    """按连接参数缓存 LangChain Azure OpenAI 实例，复用其 httpx 连接池
+    
+    Args:
+        endpoint: Azure OpenAI 端点
+        deployment: 部署名称
+        api_key: API 密钥
+        api_version: API 版本
+        max_completion_tokens: 单次请求最多输出的token数
+        
+    Returns:
+        AzureChatOpenAI: 共享的 LLM 客户端
+    """
+    # 延迟导入：langchain_openai 依赖较重，仅在实际创建客户端时加载
+    from langchain_openai import AzureChatOpenAI
+    
+    return AzureChatOpenAI(
+        azure_deployment=deployment,
+        azure_endpoint=endpoint,
+        api_key=api_key,
+        api_version=api_version,
+        temperature=1.0,
+        max_completion_tokens=max_completion_tokens
+    )
 
 class Mem0Setting:
     """Mem0 配置类，整合 LLM、嵌入器、向量存储和图存储配置"""
@@ -15,17 +47,10 @@ class Mem0Setting:
             enable_graph: 是否启用图记忆功能
             neo4j_config: Neo4j 连接配置
         """
-        # 创建 LangChain Azure OpenAI 实例
-        azure_llm = AzureChatOpenAI(
-            azure_deployment=llm.deployment,
-            azure_endpoint=llm.endpoint,
-            api_key=llm.api_key,
-            api_version=llm.api_version,
-            temperature=1.0,
-            max_completion_tokens=2000
-        )
+        # 获取（缓存的）LangChain Azure OpenAI 实例
+        azure_llm = _build_azure_llm(llm.endpoint, llm.deployment, llm.api_key, llm.api_version, llm.max_completion_tokens)
         
-        self.mem0_config = {
+        mem0_config = {
             "llm": {
                 "provider": "langchain",
                 "config": {
@@ -55,47 +80,50 @@ class Mem0Setting:
         
         # 如果启用图记忆，添加图存储配置
         if enable_graph :
-            self.mem0_config["graph_store"] = neo4j_config.get_connection_params()
+            mem0_config["graph_store"] = neo4j_config.get_connection_params()
+        
+        # 构建完成后以只读视图对外提供，避免被调用方意外修改
+        self.mem0_config: Mapping[str, Any] = MappingProxyType(mem0_config)
     
-    def get_mem0_config(self) -> dict:
+    def get_mem0_config(self) -> Mapping[str, Any]:
         """返回适用于 Mem0 的完整配置
         
         Returns:
-            dict: Mem0 配置字典
+            Mapping: Mem0 配置（只读视图）
         """
         return self.mem0_config
     
-    def get_llm_config(self) -> dict:
+    def get_llm_config(self) -> Mapping[str, Any]:
         """获取 LLM 配置
         
         Returns:
-            dict: LLM 配置字典
+            Mapping: LLM 配置（只读视图）
         """
-        return self.mem0_config["llm"]
+        return MappingProxyType(self.mem0_config["llm"])
     
-    def get_embedder_config(self) -> dict:
+    def get_embedder_config(self) -> Mapping[str, Any]:
         """获取嵌入器配置
         
         Returns:
-            dict: 嵌入器配置字典
+            Mapping: 嵌入器配置（只读视图）
         """
-        return self.mem0_config["embedder"]
+        return MappingProxyType(self.mem0_config["embedder"])
     
-    def get_vector_store_config(self) -> dict:
+    def get_vector_store_config(self) -> Mapping[str, Any]:
         """获取向量存储配置
         
         Returns:
-            dict: 向量存储配置字典
+            Mapping: 向量存储配置（只读视图）
         """
-        return self.mem0_config["vector_store"]
+        return MappingProxyType(self.mem0_config["vector_store"])
     
-    def get_graph_store_config(self) -> dict:
+    def get_graph_store_config(self) -> Mapping[str, Any]:
         """获取图存储配置
         
         Returns:
-            dict: 图存储配置字典
+            Mapping: 图存储配置（只读视图）
         """
-        return self.mem0_config.get("graph_store", {})
+        return MappingProxyType(self.mem0_config.get("graph_store", {}))
     
     def is_graph_enabled(self) -> bool:
         """检查是否启用了图记忆
@@ -105,10 +133,10 @@ class Mem0Setting:
         """
         return "graph_store" in self.mem0_config
     
-    def get_config(self) -> dict:
+    def get_config(self) -> Mapping[str, Any]:
         """获取所有的配置结构提
 
         Returns:
-            dict: 向量存储配置字典
+            Mapping: 完整配置（只读视图）
         """
         return self.mem0_config
\ No newline at end of file
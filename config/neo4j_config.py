@@ -1,17 +1,26 @@
+from dataclasses import dataclass
+import functools
 import os
-from dotenv import load_dotenv
-
-load_dotenv()
 
 
+@dataclass(frozen=True, slots=True)
 class Neo4jConfig:
     """Neo4j 数据库连接配置类"""
-    
-    def __init__(self):
-        self.url =  os.getenv("NEO4J_URI")
-        self.username = os.getenv("NEO4J_USERNAME")
-        self.password = os.getenv("NEO4J_PASSWORD")
-        self.database = os.getenv("NEO4J_DATABASE")
+    url: str | None
+    username: str | None
+    password: str | None
+    database: str | None
+
+    @classmethod
+    @functools.cache
+    def from_env(cls) -> "Neo4jConfig":
+        """从环境变量读取Neo4j配置（只读取一次）"""
+        return cls(
+            url=os.getenv("NEO4J_URI"),
+            username=os.getenv("NEO4J_USERNAME"),
+            password=os.getenv("NEO4J_PASSWORD"),
+            database=os.getenv("NEO4J_DATABASE"),
+        )
     
     def get_connection_params(self):
         return {
@@ -21,4 +30,4 @@ class Neo4jConfig:
                 "username": self.username,
                 "password": self.password,
             }
-        }
\ No newline at end of file
+        }
@@ -1,213 +1,286 @@
 import uuid
 from datetime import datetime
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple, Deque, Set, AsyncIterator
+from collections import deque
 from mem0 import Memory
 from config.llm import LLM
-import aiohttp
+from config.embedding import Embedding
+from config.mem0_setting import Mem0Setting
+from core.storage.ann_index import ANNIndex
+from core.batch_processor import BatchProcessor, count_tokens
+from core.storage.redis_cache import MISSING, get_result_cache, stable_key
 import asyncio
+import functools
+import os
+import threading
 import json
 import time
 from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import TTLCache
 import logging
-from contextlib import asynccontextmanager
+
+# 每个会话保留的最近消息条数（超出后自动淘汰最早的消息）
+_HISTORY_MAXLEN = 10
+
+# 会话记忆合并保存：累计到一定轮数或等待超时后一次性写入
+_SAVE_BATCH_TURNS = 5
+_SAVE_FLUSH_DELAY = 2.0
+
+# 系统提示及记忆段落
+_SYSTEM_PROMPT = "你是一个智能助手，能够记住用户的偏好和历史对话。"
+
+@functools.lru_cache(maxsize=1024)
+def _format_memory_block(memories: Tuple[str, ...]) -> str:
+    """将记忆列表格式化为系统提示中的记忆段落（按记忆元组缓存）"""
+    memory_context = "\n".join([f"- {memory}" for memory in memories])
+    return f"\n\n以下是用户的相关记忆信息：\n{memory_context}\n\n请基于这些记忆信息来回复用户，特别要考虑用户的偏好和兴趣。"
 
 # 添加缓存装饰器
-def async_cache(ttl_seconds=300):
-    """异步缓存装饰器"""
-    cache = {}
+def async_cache(ttl_seconds=300, maxsize=1024, scope_arg: Optional[int] = None):
+    """异步缓存装饰器（有界TTL缓存，并发的相同未命中请求只执行一次；可选Redis作为跨进程共享的二级缓存）
+    
+    使用Redis时每次调用读取一次共享的失效版本号，任一worker失效后其他worker的本地缓存随即不再命中。
+    
+    Args:
+        ttl_seconds: 缓存有效期（秒）
+        maxsize: 本地缓存的最大条目数
+        scope_arg: 作为失效范围的位置参数下标（如 user_id），指定后可通过
+            wrapper.invalidate(scope) 使该范围内的全部缓存失效
+    
+    函数抛出异常时结果不会被缓存。
+    """
+    cache = TTLCache(maxsize=maxsize, ttl=ttl_seconds)
+    pending: Dict[Any, asyncio.Task] = {}
+    # 每个失效范围的版本号：失效时递增，旧版本的缓存项不再命中，随TTL自然淘汰
+    generations: Dict[Any, int] = {}
+    lock = asyncio.Lock()
     
     def decorator(func):
+        async def current_generation(remote, scope):
+            # 本地版本号加上Redis中的共享版本号（CACHE_BACKEND=redis），其他worker的失效也会让本地缓存不再命中；
+            # Redis不可用时共享部分为 None，只依赖本地版本号
+            local = generations.get(scope, 0)
+            if remote is None:
+                return local
+            return local, await remote.get_counter(f"gen:{func.__qualname__}:{scope}")
+        
+        async def load(args, kwargs, scope, generation, remote):
+            # 本地未命中时先查询共享缓存（CACHE_BACKEND=redis），再执行函数
+            if remote is None:
+                return await func(*args, **kwargs)
+            # 同一失效范围的结果存放在同一个Redis哈希表中，失效时整表删除
+            remote_key = f"{func.__qualname__}:{scope}"
+            field = stable_key(args, kwargs)
+            result = await remote.get_field(remote_key, field)
+            if result is MISSING:
+                result = await func(*args, **kwargs)
+                # 执行期间发生了失效（本进程或其他worker），结果可能已过时，不写入共享缓存
+                if generation[1] is not None and await current_generation(remote, scope) == generation:
+                    await remote.set_field(remote_key, field, result, ttl_seconds)
+            return result
+        
         @wraps(func)
         async def wrapper(*args, **kwargs):
-            # 生成缓存键
-            cache_key = f"{func.__name__}:{hash(str(args) + str(kwargs))}"
-            current_time = time.time()
+            scope = args[scope_arg] if scope_arg is not None else None
+            remote = get_result_cache()
+            generation = await current_generation(remote, scope)
+            # 生成缓存键（直接使用参数元组，避免字符串化和哈希冲突）
+            cache_key = (func.__qualname__, generation, args, tuple(sorted(kwargs.items())))
             
-            # 检查缓存
-            if cache_key in cache:
-                result, timestamp = cache[cache_key]
-                if current_time - timestamp < ttl_seconds:
-                    return result
+            # 检查缓存，未命中时复用正在进行的同一请求
+            async with lock:
+                if cache_key in cache:
+                    return cache[cache_key]
+                task = pending.get(cache_key)
+                if task is None:
+                    task = asyncio.create_task(load(args, kwargs, scope, generation, remote))
+                    pending[cache_key] = task
             
-            # 执行函数并缓存结果
-            result = await func(*args, **kwargs)
-            cache[cache_key] = (result, current_time)
-            
-            # 清理过期缓存
-            expired_keys = [
-                key for key, (_, timestamp) in cache.items()
-                if current_time - timestamp >= ttl_seconds
-            ]
-            for key in expired_keys:
-                del cache[key]
+            try:
+                result = await asyncio.shield(task)
+            finally:
+                if task.done():
+                    pending.pop(cache_key, None)
             
+            # 缓存结果（TTLCache 在访问时惰性淘汰过期项，无需手动清理）
+            async with lock:
+                cache[cache_key] = result
             return result
+        
+        async def invalidate(scope):
+            """使指定范围（如某个用户）在所有worker中的本地和共享缓存失效"""
+            generations[scope] = generations.get(scope, 0) + 1
+            remote = get_result_cache()
+            if remote is not None:
+                await remote.incr(f"gen:{func.__qualname__}:{scope}")
+                await remote.delete(f"{func.__qualname__}:{scope}")
+        
+        wrapper.invalidate = invalidate
         return wrapper
     return decorator
 
+class CircuitOpenError(Exception):
+    """熔断器处于打开状态，请求被直接拒绝"""
+
+class CircuitBreaker:
+    """熔断器：下游连续失败达到阈值后快速失败，超时后只放行一个试探请求"""
+    
+    def __init__(self, failure_threshold=5, timeout=60):
+        self.failure_threshold = failure_threshold
+        self.timeout = timeout
+        self.failure_count = 0
+        self.last_failure_time = None
+        self.state = 'CLOSED'  # CLOSED, OPEN, HALF_OPEN
+        # HALF_OPEN 期间是否已有试探请求在执行
+        self._probing = False
+    
+    async def call(self, func, *args, **kwargs):
+        if self.state == 'OPEN':
+            if time.monotonic() - self.last_failure_time > self.timeout:
+                self.state = 'HALF_OPEN'
+            else:
+                raise CircuitOpenError("Circuit breaker is OPEN")
+        
+        # 试探请求结束前，其余请求继续快速失败
+        probe = self.state == 'HALF_OPEN'
+        if probe:
+            if self._probing:
+                raise CircuitOpenError("Circuit breaker is HALF_OPEN")
+            self._probing = True
+        
+        try:
+            result = await func(*args, **kwargs)
+        except Exception:
+            self.failure_count += 1
+            self.last_failure_time = time.monotonic()
+            
+            if self.state == 'HALF_OPEN' or self.failure_count >= self.failure_threshold:
+                self.state = 'OPEN'
+            raise
+        finally:
+            # 成功、失败或被取消都释放试探名额
+            if probe:
+                self._probing = False
+        
+        # 成功后重置计数，只有连续失败才会触发熔断
+        self.state = 'CLOSED'
+        self.failure_count = 0
+        return result
+
 class MemoryAgent:
     """高性能异步记忆Agent"""
     
-    def __init__(self, memory: Memory, llm: LLM):
+    def __init__(self, memory: Memory, llm: LLM, ann_index: Optional[ANNIndex] = None):
         self.memory = memory
         self.llm = llm
-        self.conversation_history: Dict[str, List[Dict]] = {}
-        self._session = None
-        self._session_lock = asyncio.Lock()
+        self.ann_index = ann_index
+        # LangChain LLM客户端只构建一次，所有对话复用
+        self._mem0_setting = Mem0Setting(llm, Embedding.from_env())
+        self._llm_client = self._mem0_setting.mem0_config["llm"]["config"]["model"]
+        self.conversation_history: Dict[str, Deque[Dict]] = {}
         self.logger = logging.getLogger(__name__)
-        
-        # 连接池配置
-        self._connector = aiohttp.TCPConnector(
-            limit=100,  # 总连接池大小
-            limit_per_host=30,  # 每个主机的连接数
-            ttl_dns_cache=300,  # DNS缓存时间
-            use_dns_cache=True,
-            keepalive_timeout=30,
-            enable_cleanup_closed=True
-        )
-        
-        # 超时配置
-        self._timeout = aiohttp.ClientTimeout(
-            total=30,  # 总超时时间
-            connect=5,  # 连接超时
-            sock_read=10  # 读取超时
-        )
         self._pending_requests = {}  # 添加请求去重
-    
-    @asynccontextmanager
-    async def get_session(self):
-        """获取HTTP会话的上下文管理器"""
-        async with self._session_lock:
-            if self._session is None or self._session.closed:
-                self._session = aiohttp.ClientSession(
-                    connector=self._connector,
-                    timeout=self._timeout,
-                    headers={
-                        "User-Agent": "MemoryAgent/1.0",
-                        "Connection": "keep-alive"
-                    }
-                )
-        
-        try:
-            yield self._session
-        except Exception as e:
-            self.logger.error(f"HTTP会话错误: {e}")
-            raise
-    
-    async def _call_llm_with_retry(self, messages: List[Dict[str, str]], max_retries: int = 3) -> str:
-        """带重试机制的LLM调用"""
-        headers = {
-            "api-key": self.llm.api_key,
-            "Content-Type": "application/json"
-        }
         
-        payload = {
-            "messages": messages,
-            "temperature": 0.7,
-            "max_tokens": 1000,
-            "stream": False
-        }
+        # 下游故障时快速失败，避免请求堆积在线程池中等待超时
+        self._llm_breaker = CircuitBreaker(failure_threshold=5, timeout=60)
+        self._mem_breaker = CircuitBreaker(failure_threshold=10, timeout=30)
         
-        # 构建Azure OpenAI的URL
-        azure_url = f"{self.llm.endpoint}/openai/deployments/{self.llm.deployment}/chat/completions?api-version={self.llm.api_version}"
+        # 待保存的对话轮次：session_key -> (user_id, session_id, metadata, messages)
+        self._pending_saves: Dict[str, Tuple[str, str, Optional[Dict[str, Any]], List[Dict]]] = {}
+        self._save_timers: Dict[str, asyncio.TimerHandle] = {}
+        self._bg_tasks: Set[asyncio.Task] = set()
         
-        for attempt in range(max_retries):
-            try:
-                async with self.get_session() as session:
-                    async with session.post(
-                        azure_url,
-                        headers=headers,
-                        json=payload
-                    ) as response:
-                        if response.status == 200:
-                            result = await response.json()
-                            return result["choices"][0]["message"]["content"]
-                        elif response.status == 429:  # 速率限制
-                            wait_time = 2 ** attempt
-                            self.logger.warning(f"速率限制，等待 {wait_time} 秒后重试")
-                            await asyncio.sleep(wait_time)
-                            continue
-                        else:
-                            response.raise_for_status()
-                            
-            except asyncio.TimeoutError:
-                self.logger.warning(f"LLM调用超时，第 {attempt + 1} 次重试")
-                if attempt == max_retries - 1:
-                    return "抱歉，服务暂时不可用，请稍后重试。"
-                await asyncio.sleep(1)
-            except Exception as e:
-                self.logger.error(f"LLM调用失败 (尝试 {attempt + 1}): {e}")
-                if attempt == max_retries - 1:
-                    return f"抱歉，我现在无法回复。错误：{str(e)}"
-                await asyncio.sleep(1)
+        # 记忆存储专用线程池，与默认执行器隔离，大小按后端并发能力调整
+        self._mem_executor = ThreadPoolExecutor(
+            max_workers=int(os.getenv("MEM0_POOL", "16")),
+            thread_name_prefix="mem0"
+        )
         
-        return "抱歉，服务暂时不可用。"
+        # LLM请求调度：限制并发并按RPM/TPM主动限流
+        self._batcher = BatchProcessor(
+            self._invoke_llm,
+            max_concurrency=llm.max_concurrency,
+            rpm=llm.rpm,
+            tpm=llm.tpm,
+            max_completion_tokens=llm.max_completion_tokens
+        )
     
-    @async_cache(ttl_seconds=600)  # 增加缓存时间到10分钟
+    async def _run_memory(self, func, *args, **kwargs):
+        """在记忆线程池中执行mem0操作（受熔断器保护）"""
+        loop = asyncio.get_running_loop()
+        return await self._mem_breaker.call(
+            loop.run_in_executor, self._mem_executor, functools.partial(func, *args, **kwargs)
+        )
+    
+    @async_cache(ttl_seconds=600, scope_arg=1)  # 增加缓存时间到10分钟，按用户失效
     async def _get_relevant_memories_cached(self, user_id: str, query: str, limit: int = 5) -> List[str]:
         """带缓存的记忆检索"""
         return await self._get_relevant_memories_raw(user_id, query, limit)
     
     async def _get_relevant_memories_raw(self, user_id: str, query: str, limit: int = 5) -> List[str]:
-        """原始记忆检索方法"""
-        try:
-            loop = asyncio.get_event_loop()
-            search_results = await loop.run_in_executor(
-                None, 
-                lambda: self.memory.search(query, user_id=user_id, limit=limit)
-            )
-            
-            memories = []
-            
-            if isinstance(search_results, dict) and "results" in search_results:
-                results = search_results["results"]
-                for result in results:
-                    if isinstance(result, dict):
-                        memory_text = result.get("memory") or result.get("text") or result.get("content")
-                        if memory_text:
-                            memories.append(memory_text)
-            elif isinstance(search_results, list):
-                for result in search_results:
-                    if isinstance(result, dict):
-                        memory_text = result.get("memory") or result.get("text") or result.get("content")
-                        if memory_text:
-                            memories.append(memory_text)
-                    elif isinstance(result, str):
-                        memories.append(result)
-                    else:
-                        memories.append(str(result))
-            
-            return memories
-            
-        except Exception as e:
-            self.logger.error(f"获取记忆时出错: {e}")
-            return []
+        """原始记忆检索方法（出错时抛出异常，失败结果不会进入缓存）"""
+        search_results = await self._run_memory(self._search_sync, query, user_id, limit)
+        return self._extract_texts(search_results)
+    
+    async def invalidate_memory_cache(self, user_id: str):
+        """用户记忆发生写入或删除后，使该用户的记忆检索缓存失效"""
+        await self._get_relevant_memories_cached.invalidate(user_id)
+        # 失效前发起的检索可能返回旧结果，之后的请求不再复用它们
+        for key in [key for key in self._pending_requests if key[0] == user_id]:
+            self._pending_requests.pop(key, None)
+    
+    async def _invoke_llm(self, messages: List[Dict[str, str]]) -> Any:
+        """在线程池中执行一次LLM调用（由调度器派发）"""
+        loop = asyncio.get_event_loop()
+        return await self._llm_breaker.call(loop.run_in_executor, None, self._llm_client.invoke, messages)
     
-    async def _build_context_messages_optimized(self, user_message: str, user_id: str, session_id: str) -> List[Dict[str, str]]:
-        """优化的上下文构建"""
-        # 并发获取记忆和会话历史
-        memories_task = self._get_relevant_memories_cached(user_id, user_message)
+    @staticmethod
+    def _extract_texts(results: Any) -> List[str]:
+        """将 mem0 检索结果（{"results": [...]} 或列表）统一转换为记忆文本列表"""
+        items = results.get("results", ()) if isinstance(results, dict) else (results or ())
+        texts = []
+        for item in items:
+            if isinstance(item, dict):
+                text = item.get("memory") or item.get("text") or item.get("content")
+                if text:
+                    texts.append(text)
+            elif item:
+                texts.append(item if isinstance(item, str) else str(item))
+        return texts
+    
+    def _search_sync(self, query: str, user_id: str, limit: int):
+        """同步检索记忆：优先使用ANN索引，不可用时回退到mem0检索"""
+        if self.ann_index is not None:
+            hits = self.ann_index.search_text(user_id, query, limit)
+            if hits is not None:
+                return {"results": hits}
+        return self.memory.search(query, user_id=user_id, limit=limit)
+    
+    async def _build_context_messages_optimized(self, user_message: str, user_id: str, session_id: str) -> Tuple[List[Dict[str, str]], List[str]]:
+        """优化的上下文构建，返回 (对话消息, 使用到的记忆)"""
+        # 并发获取记忆和会话历史（相同查询合并为一次检索）
+        memories_task = self._get_relevant_memories_with_dedup(user_id, user_message)
         
         # 获取会话历史（本地操作，无需异步）
         session_key = f"{user_id}_{session_id}"
-        recent_history = self.conversation_history.get(session_key, [])[-10:]
+        recent_history = self.conversation_history.get(session_key, ())
         
         # 等待记忆检索完成
         relevant_memories = await memories_task
         
-        # 构建系统提示
-        system_prompt = "你是一个智能助手，能够记住用户的偏好和历史对话。"
+        # 构建系统提示（相同记忆列表复用已格式化的文本）
+        system_prompt = _SYSTEM_PROMPT
         if relevant_memories:
-            memory_context = "\n".join([f"- {memory}" for memory in relevant_memories])
-            system_prompt += f"\n\n以下是用户的相关记忆信息：\n{memory_context}\n\n请基于这些记忆信息来回复用户，特别要考虑用户的偏好和兴趣。"
+            system_prompt += _format_memory_block(tuple(relevant_memories))
         
         messages = [{"role": "system", "content": system_prompt}]
         messages.extend(recent_history)
         messages.append({"role": "user", "content": user_message})
         
-        return messages
+        return messages, relevant_memories
     
-    async def chat(self, user_id: str, message: str, session_id: Optional[str] = None, metadata: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    async def chat(self, user_id: str, message: str, session_id: Optional[str] = None, metadata: Optional[Dict[str, Any]] = None, stream: bool = False) -> Dict[str, Any]:
         """高性能异步对话处理 - 使用正确的mem0模式"""
         start_time = time.time()
         
@@ -218,73 +291,20 @@ class MemoryAgent:
         
         # 初始化会话历史
         if session_key not in self.conversation_history:
-            self.conversation_history[session_key] = []
+            self.conversation_history[session_key] = deque(maxlen=_HISTORY_MAXLEN)
         
         try:
-            loop = asyncio.get_event_loop()
-            
-            # 1. 检索相关记忆
-            relevant_memories = await loop.run_in_executor(
-                None,
-                lambda: self.memory.search(query=message, user_id=user_id, limit=5)
-            )
-            
-            # 处理记忆格式
-            memories_text = []
-            if isinstance(relevant_memories, dict) and "results" in relevant_memories:
-                for memory in relevant_memories["results"]:
-                    if isinstance(memory, dict) and "memory" in memory:
-                        memories_text.append(memory["memory"])
-            elif isinstance(relevant_memories, list):
-                for memory in relevant_memories:
-                    if isinstance(memory, dict):
-                        memory_content = memory.get("memory") or memory.get("text") or memory.get("content")
-                        if memory_content:
-                            memories_text.append(memory_content)
-            
-            # 2. 构建带记忆上下文的对话
-            memories_context = "\n".join([f"- {memory}" for memory in memories_text]) if memories_text else ""
-            system_prompt = f"你是一个智能助手，能够记住用户的偏好和历史对话。"
-            if memories_context:
-                system_prompt += f"\n\n用户相关记忆信息：\n{memories_context}\n\n请基于这些记忆信息来回复用户。"
+            # 1. 检索相关记忆并构建带记忆上下文的对话
+            messages, memories_text = await self._build_context_messages_optimized(message, user_id, session_id)
             
-            messages = [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": message}
-            ]
-            
-            # 3. 使用langchain调用LLM (通过mem0的配置)
-            from config.mem0_setting import Mem0Setting
-            from config.llm import LLM
-            from config.embedding import Embedding
-            
-            llm_config = LLM()
-            embedding_config = Embedding()
-            mem0_setting = Mem0Setting(llm_config, embedding_config)
-            llm_client = mem0_setting.mem0_config["llm"]["config"]["model"]
-            
-            # 检查是否支持流式输出
-            stream_mode = metadata.get('stream', False) if metadata else False
-            
-            if stream_mode:
-                # 流式输出模式
-                response_stream = await loop.run_in_executor(
-                    None,
-                    lambda: llm_client.stream(messages)
-                )
-                
-                # 收集流式输出内容
-                response_chunks = []
-                async def collect_stream():
-                    for chunk in response_stream:
-                        if hasattr(chunk, 'content'):
-                            response_chunks.append(chunk.content)
-                            yield chunk.content
-                
-                response = ''.join(response_chunks)
+            # 2. 使用langchain调用LLM (通过mem0的配置)
+            if stream:
+                # 流式输出模式：逐块转发LLM输出，结束后再保存对话
                 return {
                     "stream": True,
-                    "response_generator": collect_stream(),
+                    "response_generator": self._stream_response(
+                        messages, session_key, user_id, session_id, message, metadata
+                    ),
                     "user_id": user_id,
                     "session_id": session_id,
                     "memories_used": memories_text,
@@ -292,25 +312,11 @@ class MemoryAgent:
                 }
             else:
                 # 普通模式
-                response_obj = await loop.run_in_executor(
-                    None,
-                    lambda: llm_client.invoke(messages)
-                )
+                response_obj = await self._batcher.submit(messages)
                 response = response_obj.content
             
-            # 4. 异步保存记忆到后台任务 (不阻塞响应)
-            conversation_messages = [
-                {"role": "user", "content": message},
-                {"role": "assistant", "content": response}
-            ]
-            
-            # 后台异步保存，不等待完成
-            asyncio.create_task(self._save_memory_background(
-                conversation_messages, user_id, session_id, metadata
-            ))
-            
-            # 更新会话历史
-            self.conversation_history[session_key].extend(conversation_messages)
+            # 3. 异步保存记忆到后台任务 (不阻塞响应) 并更新会话历史
+            self._record_turn(session_key, user_id, session_id, message, response, metadata)
             
             processing_time = time.time() - start_time
             self.logger.info(f"对话处理完成，耗时: {processing_time:.2f}秒")
@@ -335,58 +341,126 @@ class MemoryAgent:
                 "error": str(e)
             }
     
+    def _record_turn(self, session_key: str, user_id: str, session_id: str, message: str, response: str, metadata: Optional[Dict[str, Any]]):
+        """记录一轮完成的对话：加入待保存缓冲并更新会话历史"""
+        conversation_messages = [
+            {"role": "user", "content": message},
+            {"role": "assistant", "content": response}
+        ]
+        
+        # 按会话合并后在后台保存，不等待完成
+        self._queue_save(session_key, conversation_messages, user_id, session_id, metadata)
+        
+        # 更新会话历史
+        history = self.conversation_history.setdefault(session_key, deque(maxlen=_HISTORY_MAXLEN))
+        history.append(conversation_messages[0])
+        history.append(conversation_messages[1])
+    
+    async def _stream_response(self, messages: List[Dict[str, str]], session_key: str, user_id: str, session_id: str, message: str, metadata: Optional[Dict[str, Any]]) -> AsyncIterator[str]:
+        """逐块产出LLM流式输出
+        
+        LangChain 的 stream() 是同步迭代器，在线程中消费并通过队列把每个片段
+        转交给事件循环，调用方收到第一个片段即可开始响应，而不必等待完整回复。
+        流正常结束后保存本轮对话。
+        """
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        stop = threading.Event()
+        
+        def produce():
+            try:
+                for chunk in self._llm_client.stream(messages):
+                    if stop.is_set():
+                        break
+                    content = getattr(chunk, "content", None)
+                    if content:
+                        loop.call_soon_threadsafe(queue.put_nowait, content)
+            except Exception as e:
+                loop.call_soon_threadsafe(queue.put_nowait, e)
+            finally:
+                loop.call_soon_threadsafe(queue.put_nowait, None)
+        
+        chunks = []
+        # 流式请求同样受并发上限和RPM/TPM限流约束
+        async with self._batcher.slot(messages) as reservation:
+            producer = loop.run_in_executor(None, produce)
+            try:
+                while True:
+                    item = await queue.get()
+                    if item is None:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    chunks.append(item)
+                    yield item
+            finally:
+                # 客户端断开时通知生产线程尽快停止
+                stop.set()
+            
+            await producer
+            # 流式响应不带用量信息，按提示token数加实际输出估算
+            if self._batcher.tpm is not None:
+                reservation.settle(reservation.prompt_tokens + count_tokens([{"role": "assistant", "content": "".join(chunks)}]))
+        self._record_turn(session_key, user_id, session_id, message, "".join(chunks), metadata)
+    
+    def _queue_save(self, session_key: str, conversation_messages: List[Dict], user_id: str, session_id: str, metadata: Optional[Dict[str, Any]]):
+        """缓冲一轮对话，累计满 _SAVE_BATCH_TURNS 轮或等待 _SAVE_FLUSH_DELAY 秒后合并保存"""
+        pending = self._pending_saves.get(session_key)
+        if pending is not None and pending[2] != metadata:
+            # 元数据不同的轮次不能合并，先保存已缓冲的部分
+            self._flush_saves(session_key)
+            pending = None
+        if pending is None:
+            pending = (user_id, session_id, metadata, [])
+            self._pending_saves[session_key] = pending
+        pending[3].extend(conversation_messages)
+        
+        if len(pending[3]) >= _SAVE_BATCH_TURNS * 2:
+            self._flush_saves(session_key)
+        elif session_key not in self._save_timers:
+            loop = asyncio.get_running_loop()
+            self._save_timers[session_key] = loop.call_later(_SAVE_FLUSH_DELAY, self._flush_saves, session_key)
+    
+    def _flush_saves(self, session_key: str) -> Optional[asyncio.Task]:
+        """将会话缓冲的对话一次性提交到后台保存"""
+        timer = self._save_timers.pop(session_key, None)
+        if timer is not None:
+            timer.cancel()
+        pending = self._pending_saves.pop(session_key, None)
+        if pending is None:
+            return None
+        user_id, session_id, metadata, messages = pending
+        task = asyncio.create_task(self._save_memory_background(messages, user_id, session_id, metadata))
+        # 保留任务引用，防止被垃圾回收，并在关闭时等待其完成
+        self._bg_tasks.add(task)
+        task.add_done_callback(self._bg_tasks.discard)
+        return task
+    
     async def _save_memory_background(self, conversation_messages: List[Dict], user_id: str, session_id: str, metadata: Optional[Dict[str, Any]]):
         """后台异步保存记忆任务"""
         try:
             loop = asyncio.get_event_loop()
-            await loop.run_in_executor(
-                None,
-                lambda: self.memory.add(
-                    conversation_messages, 
-                    user_id=user_id, 
-                    metadata={
-                        "session_id": session_id,
-                        "timestamp": datetime.now().isoformat(),
-                        **(metadata or {})
-                    }
-                )
+            result = await self._run_memory(
+                self.memory.add,
+                conversation_messages,
+                user_id=user_id,
+                metadata={
+                    "session_id": session_id,
+                    "timestamp": datetime.now().isoformat(),
+                    **(metadata or {})
+                }
             )
+            if self.ann_index is not None:
+                await loop.run_in_executor(self._mem_executor, self.ann_index.apply_add_result, user_id, result)
+            await self.invalidate_memory_cache(user_id)
             self.logger.info(f"后台记忆保存成功: user_id={user_id}")
         except Exception as e:
             self.logger.error(f"后台记忆保存失败: {e}")
     
-    async def _save_memory_async(self, user_id: str, session_id: str, user_message: str, response: str, metadata: Optional[Dict[str, Any]]):
-        """异步保存记忆（后台任务）"""
-        try:
-            conversation_messages = [
-                {"role": "user", "content": user_message},
-                {"role": "assistant", "content": response}
-            ]
-            
-            loop = asyncio.get_event_loop()
-            await loop.run_in_executor(
-                None,
-                lambda: self.memory.add(
-                    conversation_messages, 
-                    user_id=user_id, 
-                    metadata={
-                        "session_id": session_id,
-                        "timestamp": datetime.now().isoformat(),
-                        **(metadata or {})
-                    }
-                )
-            )
-        except Exception as e:
-            self.logger.error(f"后台保存记忆失败: {e}")
-    
     async def search_memories(self, user_id: str, query: str, limit: int = 10) -> List[Dict[str, Any]]:
         """异步搜索用户记忆"""
         try:
-            loop = asyncio.get_event_loop()
-            return await loop.run_in_executor(
-                None,
-                lambda: self.memory.search(query, user_id=user_id, limit=limit)
-            )
+            return await self._run_memory(self._search_sync, query, user_id, limit)
         except Exception as e:
             print(f"搜索记忆时出错: {e}")
             return []
@@ -394,11 +468,7 @@ class MemoryAgent:
     async def get_all_memories(self, user_id: str) -> List[Dict[str, Any]]:
         """异步获取用户所有记忆"""
         try:
-            loop = asyncio.get_event_loop()
-            return await loop.run_in_executor(
-                None,
-                lambda: self.memory.get_all(user_id=user_id)
-            )
+            return await self._run_memory(self.memory.get_all, user_id=user_id)
         except Exception as e:
             print(f"获取所有记忆时出错: {e}")
             return []
@@ -406,11 +476,14 @@ class MemoryAgent:
     async def delete_memory(self, memory_id: str) -> bool:
         """异步删除指定记忆"""
         try:
-            loop = asyncio.get_event_loop()
-            await loop.run_in_executor(
-                None,
-                lambda: self.memory.delete(memory_id=memory_id)
-            )
+            # 先查出记忆所属用户，删除后使其检索缓存失效
+            existing = await self._run_memory(self.memory.get, memory_id)
+            await self._run_memory(self.memory.delete, memory_id=memory_id)
+            if self.ann_index is not None:
+                # 索引更新会读写版本号（可能访问Redis），不在事件循环线程中执行
+                await self._run_memory(self.ann_index.remove, memory_id, existing.get("user_id") if existing else None)
+            if existing and existing.get("user_id"):
+                await self.invalidate_memory_cache(existing["user_id"])
             return True
         except Exception as e:
             print(f"删除记忆时出错: {e}")
@@ -419,15 +492,19 @@ class MemoryAgent:
     async def clear_user_memories(self, user_id: str) -> bool:
         """异步清除用户所有记忆"""
         try:
-            loop = asyncio.get_event_loop()
-            await loop.run_in_executor(
-                None,
-                lambda: self.memory.delete_all(user_id=user_id)
-            )
-            # 同时清除会话历史
+            await self._run_memory(self.memory.delete_all, user_id=user_id)
+            if self.ann_index is not None:
+                await self._run_memory(self.ann_index.invalidate, user_id)
+            await self.invalidate_memory_cache(user_id)
+            # 同时清除会话历史和尚未保存的对话
             keys_to_remove = [key for key in self.conversation_history.keys() if key.startswith(f"{user_id}_")]
             for key in keys_to_remove:
                 del self.conversation_history[key]
+            for key in [key for key in self._pending_saves if key.startswith(f"{user_id}_")]:
+                self._pending_saves.pop(key, None)
+                timer = self._save_timers.pop(key, None)
+                if timer is not None:
+                    timer.cancel()
             return True
         except Exception as e:
             print(f"清除用户记忆时出错: {e}")
@@ -435,56 +512,35 @@ class MemoryAgent:
     
     async def close(self):
         """清理资源"""
-        if self._session and not self._session.closed:
-            await self._session.close()
-        if self._connector:
-            await self._connector.close()
-    
-    
-    class CircuitBreaker:
-        def __init__(self, failure_threshold=5, timeout=60):
-            self.failure_threshold = failure_threshold
-            self.timeout = timeout
-            self.failure_count = 0
-            self.last_failure_time = None
-            self.state = 'CLOSED'  # CLOSED, OPEN, HALF_OPEN
-        
-        async def call(self, func, *args, **kwargs):
-            if self.state == 'OPEN':
-                if time.time() - self.last_failure_time > self.timeout:
-                    self.state = 'HALF_OPEN'
-                else:
-                    raise Exception("Circuit breaker is OPEN")
-            
-            try:
-                result = await func(*args, **kwargs)
-                if self.state == 'HALF_OPEN':
-                    self.state = 'CLOSED'
-                    self.failure_count = 0
-                return result
-            except Exception as e:
-                self.failure_count += 1
-                self.last_failure_time = time.time()
-                
-                if self.failure_count >= self.failure_threshold:
-                    self.state = 'OPEN'
-                    
-                raise e
+        # 保存所有尚未写入的对话，并等待后台任务完成
+        for key in list(self._pending_saves):
+            self._flush_saves(key)
+        if self._bg_tasks:
+            await asyncio.gather(*self._bg_tasks, return_exceptions=True)
+        self._mem_executor.shutdown(wait=False, cancel_futures=True)
     
     async def _get_relevant_memories_with_dedup(self, user_id: str, query: str, limit: int = 5):
         """带去重的记忆检索"""
-        request_key = f"{user_id}:{hash(query)}:{limit}"
+        request_key = (user_id, query, limit)
         
         if request_key in self._pending_requests:
-            return await self._pending_requests[request_key]
+            # 加入进行中的请求；它失败时与发起方一样降级为空结果
+            try:
+                return await self._pending_requests[request_key]
+            except Exception as e:
+                self.logger.error(f"获取记忆时出错: {e}")
+                return []
         
         # 创建新的请求任务
         task = asyncio.create_task(self._get_relevant_memories_cached(user_id, query, limit))
         self._pending_requests[request_key] = task
         
         try:
-            result = await task
-            return result
+            return await task
+        except Exception as e:
+            self.logger.error(f"获取记忆时出错: {e}")
+            return []
         finally:
-            # 清理完成的请求
-            self._pending_requests.pop(request_key, None)
\ No newline at end of file
+            # 清理完成的请求（失效后该键可能已指向新的请求）
+            if self._pending_requests.get(request_key) is task:
+                self._pending_requests.pop(request_key, None)
\ No newline at end of file
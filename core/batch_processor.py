@@ -0,0 +1,160 @@
+from collections import deque
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional
+import asyncio
+import contextlib
+import functools
+import logging
+import time
+
+try:
+    import tiktoken
+except ImportError:  # 可选依赖：未安装时按字符数估算token
+    tiktoken = None
+
+# 速率限制的统计窗口（秒）
+_WINDOW = 60.0
+
+
+@functools.cache
+def _get_encoding():
+    """加载token编码器（只加载一次），不可用时返回 None"""
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        return None
+
+
+def count_tokens(messages: List[Dict[str, str]]) -> int:
+    """估算一组对话消息的token数"""
+    encoding = _get_encoding()
+    total = 0
+    for message in messages:
+        content = message.get("content") or ""
+        total += len(encoding.encode(content)) if encoding is not None else len(content)
+        total += 4  # 每条消息的角色和分隔符开销
+    return total
+
+
+def usage_tokens(result: Any) -> Optional[int]:
+    """读取 LangChain 响应中服务端报告的总token数（提示 + 输出），没有用量信息时返回 None"""
+    usage = getattr(result, "usage_metadata", None)
+    if not usage:
+        return None
+    return usage.get("total_tokens")
+
+
+class Reservation:
+    """一次请求在TPM窗口中预留的token数，响应后按实际用量校正"""
+
+    __slots__ = ("prompt_tokens", "_entry", "_processor")
+
+    def __init__(self, processor: "BatchProcessor", prompt_tokens: int, entry: Optional[List]):
+        self.prompt_tokens = prompt_tokens
+        self._entry = entry
+        self._processor = processor
+
+    def settle(self, tokens: int):
+        """用实际消耗的token数替换预留值"""
+        self._processor._settle(self._entry, tokens)
+
+
+class BatchProcessor:
+    """LLM请求调度器
+
+    请求提交后立即派发，不额外等待；通过信号量限制同时进行的请求数，
+    并按每分钟请求数（RPM）和token数（TPM）主动限流，避免触发服务端的速率限制后反复重试。
+    TPM按提示token数加最大输出token数预留，响应后按服务端报告的实际用量校正。
+    """
+
+    def __init__(self, call: Callable[..., Awaitable[Any]], max_concurrency: int = 10,
+                 rpm: Optional[int] = None, tpm: Optional[int] = None, max_completion_tokens: int = 0):
+        """初始化调度器
+
+        Args:
+            call: 实际执行单个请求的协程函数，第一个参数为消息列表
+            max_concurrency: 最大并发请求数
+            rpm: 每分钟最大请求数，None 表示不限制
+            tpm: 每分钟最大token数，None 表示不限制
+            max_completion_tokens: 单次请求最多输出的token数（计入TPM预留）
+        """
+        self.call = call
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_completion_tokens = max_completion_tokens
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        # 窗口内的用量记录：[发送时间, token数]，token数在响应后校正
+        self._usage: Deque[List] = deque()
+        self._usage_tokens = 0
+        self._limit_lock = asyncio.Lock()
+        self.logger = logging.getLogger(__name__)
+        if tpm is not None:
+            # tiktoken 首次加载编码时可能需要下载BPE文件，在启动时完成，避免阻塞请求处理
+            _get_encoding()
+
+    async def submit(self, messages: List[Dict[str, str]], *args) -> Any:
+        """在并发和速率限制内执行一个请求
+
+        Args:
+            messages: 对话消息列表
+            *args: 传给 call 的其余参数
+
+        Returns:
+            Any: call 的返回值
+        """
+        async with self.slot(messages) as reservation:
+            result = await self.call(messages, *args)
+            used = usage_tokens(result)
+            if used is not None:
+                reservation.settle(used)
+            return result
+
+    @contextlib.asynccontextmanager
+    async def slot(self, messages: List[Dict[str, str]]) -> AsyncIterator[Reservation]:
+        """在速率限制内占用一个并发名额，供不经过 submit 的请求（如流式输出）使用
+
+        Args:
+            messages: 对话消息列表（用于统计token数）
+
+        Yields:
+            Reservation: 本次请求的token预留，调用方得知实际用量后可调用 settle 校正
+        """
+        # 只有设置了TPM时才需要统计token
+        prompt_tokens = count_tokens(messages) if self.tpm is not None else 0
+        entry = await self._acquire(prompt_tokens + self.max_completion_tokens if self.tpm is not None else 0)
+        async with self._semaphore:
+            yield Reservation(self, prompt_tokens, entry)
+
+    async def _acquire(self, tokens: int) -> Optional[List]:
+        """等待直到当前窗口内的请求数和token数允许发送，返回本次请求的用量记录"""
+        if self.rpm is None and self.tpm is None:
+            return None
+        async with self._limit_lock:
+            while True:
+                now = time.monotonic()
+                while self._usage and now - self._usage[0][0] >= _WINDOW:
+                    _, used = self._usage.popleft()
+                    self._usage_tokens -= used
+
+                rpm_ok = self.rpm is None or len(self._usage) < self.rpm
+                # 单个请求超过TPM上限时，只要窗口为空就放行，避免永久阻塞
+                tpm_ok = self.tpm is None or not self._usage or self._usage_tokens + tokens <= self.tpm
+                if rpm_ok and tpm_ok:
+                    entry = [now, tokens]
+                    self._usage.append(entry)
+                    self._usage_tokens += tokens
+                    return entry
+
+                wait_time = _WINDOW - (now - self._usage[0][0])
+                self.logger.warning(f"LLM请求达到速率上限，等待 {wait_time:.2f} 秒")
+                await asyncio.sleep(wait_time)
+
+    def _settle(self, entry: Optional[List], tokens: int):
+        """用实际用量替换预留的token数（记录已移出窗口时不再计入）"""
+        if entry is None or self.tpm is None:
+            return
+        if time.monotonic() - entry[0] >= _WINDOW:
+            return
+        self._usage_tokens += tokens - entry[1]
+        entry[1] = tokens
@@ -0,0 +1,296 @@
+from typing import List, Dict, Any, Optional, Tuple
+from datetime import datetime
+from mem0 import Memory
+from core.storage.ann_index import ANNIndex
+import asyncio
+import hashlib
+import logging
+import uuid
+
+# Azure OpenAI 单次嵌入请求最多接受的输入条数
+_MAX_EMBED_INPUTS = 2048
+
+class MemoryBatchWriter:
+    """跨请求合并写入的批量记忆写入器
+
+    在一个很短的时间窗口内收集多个批量添加请求的记忆条目，
+    通过分块的批量嵌入请求和一次向量库写入完成存储，减少Azure嵌入调用和Chroma事务次数；
+    合并执行失败时逐个请求重试，只让出错的请求失败。
+    条目按原始内容直接存储（等同于 mem0 的 infer=False），不经过LLM事实抽取。
+    """
+
+    def __init__(self, memory: Memory, max_batch: int = 256, flush_interval: float = 0.02, ann_index: Optional[ANNIndex] = None):
+        """初始化写入器
+
+        Args:
+            memory: mem0 Memory实例
+            max_batch: 合并窗口收集的最大条目数，也是单次嵌入请求的最大输入数
+            flush_interval: 合并等待窗口（秒）
+            ann_index: 需要同步更新的ANN索引
+        """
+        self.memory = memory
+        self.ann_index = ann_index
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._consumer: Optional[asyncio.Task] = None
+        self.logger = logging.getLogger(__name__)
+
+    def start(self):
+        """启动后台消费任务（需在事件循环中调用）"""
+        if self._consumer is None or self._consumer.done():
+            self._consumer = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """停止后台消费任务，未处理的请求以失败结束"""
+        if self._consumer is not None:
+            self._consumer.cancel()
+            try:
+                await self._consumer
+            except asyncio.CancelledError:
+                pass
+            self._consumer = None
+
+        while not self._queue.empty():
+            _, _, future = self._queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError("批量写入器已停止"))
+
+    async def submit(self, memories_data: List[Dict[str, Any]], user_id: str) -> Dict[str, Any]:
+        """提交一批记忆并等待写入完成
+
+        Args:
+            memories_data: 记忆数据列表，每项包含 content 和可选的 metadata
+            user_id: 用户ID
+
+        Returns:
+            Dict: 批量添加结果（成功/失败数量及每条记忆的结果）
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((memories_data, user_id, future))
+        return await future
+
+    async def _run(self):
+        """后台消费循环：收集窗口内的请求后统一写入"""
+        loop = asyncio.get_running_loop()
+        while True:
+            pending = [await self._queue.get()]
+            count = len(pending[0][0])
+            deadline = loop.time() + self.flush_interval
+
+            try:
+                while count < self.max_batch:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                    pending.append(item)
+                    count += len(item[0])
+
+                requests = [(memories_data, user_id) for memories_data, user_id, _ in pending]
+                results = await loop.run_in_executor(None, self._write_batch, requests)
+            except asyncio.CancelledError:
+                for _, _, future in pending:
+                    if not future.done():
+                        future.set_exception(RuntimeError("批量写入器已停止"))
+                raise
+            except Exception as e:
+                self.logger.error(f"批量写入任务异常: {str(e)}")
+                for _, _, future in pending:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_, _, future), result in zip(pending, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def _embed_many(self, texts: List[str]) -> List[List[float]]:
+        """分块获取多条文本的嵌入向量，每次请求不超过 max_batch 条；嵌入器不支持批量时逐条获取"""
+        embedder = self.memory.embedding_model
+        client = getattr(embedder, "client", None)
+        if client is None or not hasattr(client, "embeddings"):
+            return [embedder.embed(text, "add") for text in texts]
+
+        chunk_size = min(self.max_batch, _MAX_EMBED_INPUTS)
+        vectors = []
+        for start in range(0, len(texts), chunk_size):
+            response = client.embeddings.create(
+                input=[text.replace("\n", " ") for text in texts[start:start + chunk_size]],
+                model=embedder.config.model
+            )
+            vectors.extend(item.embedding for item in response.data)
+        return vectors
+
+    def _run_isolated(self, action: str, writes: List["_RequestWrite"], func):
+        """对所有请求的条目合并执行一次 func；失败时逐个请求重试，只让出错的请求失败
+
+        Args:
+            action: 操作名称（用于日志）
+            writes: 待处理的请求
+            func: 接收请求列表的处理函数
+        """
+        try:
+            func(writes)
+            return
+        except Exception as e:
+            if len(writes) == 1:
+                self.logger.error(f"批量{action}失败: {str(e)}")
+                writes[0].error = str(e)
+                return
+            self.logger.warning(f"合并{action}失败，改为逐个请求{action}: {str(e)}")
+        for write in writes:
+            try:
+                func([write])
+            except Exception as e:
+                self.logger.error(f"用户 {write.user_id} 的批量{action}失败: {str(e)}")
+                write.error = str(e)
+
+    def _embed_writes(self, writes: List["_RequestWrite"]):
+        vectors = self._embed_many([text for write in writes for text in write.texts])
+        start = 0
+        for write in writes:
+            write.vectors = vectors[start:start + len(write.texts)]
+            start += len(write.texts)
+
+    def _insert_writes(self, writes: List["_RequestWrite"]):
+        self.memory.vector_store.insert(
+            vectors=[vector for write in writes for vector in write.vectors],
+            ids=[memory_id for write in writes for memory_id in write.ids],
+            payloads=[payload for write in writes for payload in write.payloads]
+        )
+
+    @staticmethod
+    def _validate(memory_data: Any) -> Optional[str]:
+        """校验单条记忆数据，有效时返回 None，否则返回错误描述"""
+        if not isinstance(memory_data, dict):
+            return "记忆数据必须是对象"
+        content = memory_data.get('content')
+        if not isinstance(content, str):
+            return "记忆内容必须是字符串"
+        if not content:
+            return "记忆内容为空"
+        metadata = memory_data.get('metadata')
+        if metadata is not None and not isinstance(metadata, dict):
+            return "元数据必须是对象"
+        return None
+
+    def _write_batch(self, requests: List[Tuple[List[Dict[str, Any]], str]]) -> List[Dict[str, Any]]:
+        """将多个请求的记忆一次性写入向量库
+
+        Args:
+            requests: (记忆数据列表, 用户ID) 列表
+
+        Returns:
+            List[Dict]: 与 requests 一一对应的批量添加结果
+        """
+        timestamp = datetime.now().isoformat()
+        writes = []
+
+        for memories_data, user_id in requests:
+            write = _RequestWrite(memories_data, user_id)
+            for i, memory_data in enumerate(memories_data):
+                # 逐条校验，无效条目只影响自身，不会让同一窗口内的其他请求失败
+                invalid = self._validate(memory_data)
+                if invalid is not None:
+                    write.results.append({
+                        "index": i,
+                        "result": {
+                            "success": False,
+                            "message": f"处理失败: {invalid}",
+                            "error": invalid
+                        }
+                    })
+                    continue
+
+                content = memory_data["content"]
+                memory_id = str(uuid.uuid4())
+                # 与 MemoryService.add_memory 一致：调用方元数据优先于默认时间戳
+                payload = {
+                    "timestamp": timestamp,
+                    **(memory_data.get('metadata') or {}),
+                    "user_id": user_id,
+                    "data": content,
+                    "hash": hashlib.md5(content.encode()).hexdigest(),
+                    "created_at": timestamp
+                }
+                write.texts.append(content)
+                write.ids.append(memory_id)
+                write.payloads.append(payload)
+                write.results.append({
+                    "index": i,
+                    "result": {
+                        "success": True,
+                        "message": "记忆添加成功",
+                        "memory_id": memory_id,
+                        "user_id": user_id,
+                        "timestamp": payload["timestamp"]
+                    }
+                })
+            writes.append(write)
+
+        # 嵌入和写入先合并执行，出错时逐个请求重试，一个请求的问题不会让同一窗口内的其他请求失败
+        pending = [write for write in writes if write.texts]
+        if pending:
+            self._run_isolated("嵌入", pending, self._embed_writes)
+            pending = [write for write in pending if write.error is None]
+        if pending:
+            self._run_isolated("写入", pending, self._insert_writes)
+            pending = [write for write in pending if write.error is None]
+        for write in pending:
+            try:
+                for memory_id, content in zip(write.ids, write.texts):
+                    self.memory.db.add_history(memory_id, None, content, "ADD", created_at=timestamp)
+            except Exception as e:
+                self.logger.error(f"记录记忆历史失败: {str(e)}")
+                write.error = str(e)
+                continue
+            if self.ann_index is not None:
+                self.ann_index.add(write.user_id, write.ids)
+        written = sum(len(write.texts) for write in pending if write.error is None)
+        if written:
+            self.logger.info(f"批量写入 {written} 条记忆（合并 {len(requests)} 个请求）")
+
+        batch_results = []
+        for write in writes:
+            results = write.results
+            if write.error is not None:
+                for item in results:
+                    if item["result"]["success"]:
+                        item["result"] = {
+                            "success": False,
+                            "message": f"处理失败: {write.error}",
+                            "error": write.error
+                        }
+            success_count = sum(1 for item in results if item["result"]["success"])
+            failed_count = len(results) - success_count
+            batch_results.append({
+                "success": failed_count == 0,
+                "message": f"批量添加完成，成功: {success_count}，失败: {failed_count}",
+                "user_id": write.user_id,
+                "total_processed": len(write.memories_data),
+                "success_count": success_count,
+                "failed_count": failed_count,
+                "results": results,
+                "timestamp": timestamp
+            })
+        return batch_results
+
+
+class _RequestWrite:
+    """一个批量添加请求在合并写入中的条目和状态"""
+
+    __slots__ = ("memories_data", "user_id", "texts", "ids", "payloads", "vectors", "results", "error")
+
+    def __init__(self, memories_data: List[Dict[str, Any]], user_id: str):
+        self.memories_data = memories_data
+        self.user_id = user_id
+        self.texts: List[str] = []
+        self.ids: List[str] = []
+        self.payloads: List[Dict[str, Any]] = []
+        self.vectors: List[List[float]] = []
+        self.results: List[Dict[str, Any]] = []
+        self.error: Optional[str] = None
@@ -1,14 +1,17 @@
 from typing import List, Dict, Any, Optional
+from collections import Counter
 from datetime import datetime
 from mem0 import Memory
+from core.storage.ann_index import ANNIndex
 import uuid
 import logging
 
 class MemoryService:
     """完全封装的记忆管理服务"""
     
-    def __init__(self, memory: Memory):
+    def __init__(self, memory: Memory, ann_index: Optional[ANNIndex] = None):
         self.memory = memory
+        self.ann_index = ann_index
         self.logger = logging.getLogger(__name__)
     
     def add_memory(self, 
@@ -43,6 +46,8 @@ class MemoryService:
             
             # 添加到mem0
             result = self.memory.add(messages, user_id=user_id, metadata=default_metadata)
+            if self.ann_index is not None:
+                self.ann_index.apply_add_result(user_id, result)
             
             self.logger.info(f"成功为用户 {user_id} 添加记忆")
             
@@ -90,8 +95,14 @@ class MemoryService:
             if filters:
                 search_params.update(filters)
             
-            # 执行搜索
-            results = self.memory.search(**search_params)
+            # 优先使用ANN索引检索，不可用时回退到mem0检索
+            hits = None
+            if self.ann_index is not None and not filters:
+                hits = self.ann_index.search_text(user_id, query, limit)
+            if hits is not None:
+                results = {"results": hits}
+            else:
+                results = self.memory.search(**search_params)
             
             self.logger.info(f"为用户 {user_id} 搜索记忆，查询: '{query}'，找到 {len(results)} 条结果")
             
@@ -156,7 +167,11 @@ class MemoryService:
             Dict: 删除结果
         """
         try:
+            # 先查出记忆所属用户，供调用方使其检索缓存失效
+            existing = self.memory.get(memory_id)
             self.memory.delete(memory_id=memory_id)
+            if self.ann_index is not None:
+                self.ann_index.remove(memory_id, existing.get("user_id") if existing else None)
             
             self.logger.info(f"成功删除记忆: {memory_id}")
             
@@ -164,6 +179,7 @@ class MemoryService:
                 "success": True,
                 "message": "记忆删除成功",
                 "memory_id": memory_id,
+                "user_id": existing.get("user_id") if existing else None,
                 "timestamp": datetime.now().isoformat()
             }
             
@@ -186,11 +202,12 @@ class MemoryService:
         """
         try:
             # 先获取记忆数量
-            memories = self.memory.get_all(user_id=user_id)
-            count = len(memories)
+            count = self._count_user_memories(user_id)
             
             # 删除所有记忆
             self.memory.delete_all(user_id=user_id)
+            if self.ann_index is not None:
+                self.ann_index.invalidate(user_id)
             
             self.logger.info(f"成功删除用户 {user_id} 的所有记忆，共 {count} 条")
             
@@ -210,6 +227,21 @@ class MemoryService:
                 "error": str(e)
             }
     
+    def _count_user_memories(self, user_id: str) -> int:
+        """统计用户记忆数量，向量库支持时只读取ID，不加载记忆内容
+        
+        Args:
+            user_id: 用户ID
+            
+        Returns:
+            int: 记忆数量
+        """
+        collection = getattr(self.memory.vector_store, "collection", None)
+        if collection is not None:
+            return len(collection.get(where={"user_id": user_id}, include=[])["ids"])
+        memories = self.memory.get_all(user_id=user_id)
+        return len(memories.get("results", []) if isinstance(memories, dict) else memories)
+    
     def update_memory(self, memory_id: str, new_content: str, metadata: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
         """更新记忆内容
         
@@ -222,25 +254,24 @@ class MemoryService:
             Dict: 更新结果
         """
         try:
-            # mem0可能不直接支持更新，我们先删除再添加
-            # 这里需要根据实际的mem0 API来调整
-            update_metadata = {
-                "updated_at": datetime.now().isoformat(),
-                "original_memory_id": memory_id
-            }
-            
+            # mem0 的 update 只替换内容和向量，不接受自定义元数据
             if metadata:
-                update_metadata.update(metadata)
-            
-            # 注意：这里需要根据mem0的实际API来实现更新逻辑
-            # 如果mem0支持直接更新，使用对应的方法
-            
-            self.logger.info(f"尝试更新记忆: {memory_id}")
-            
+                self.logger.info(f"记忆 {memory_id} 的更新元数据不会写入: {list(metadata)}")
+
+            # 先查出记忆所属用户，供调用方使其检索缓存失效
+            existing = self.memory.get(memory_id)
+            self.memory.update(memory_id=memory_id, data=new_content)
+            user_id = existing.get("user_id") if existing else None
+            if self.ann_index is not None and user_id:
+                self.ann_index.add(user_id, [memory_id])
+
+            self.logger.info(f"成功更新记忆: {memory_id}")
+
             return {
                 "success": True,
                 "message": "记忆更新成功",
                 "memory_id": memory_id,
+                "user_id": user_id,
                 "timestamp": datetime.now().isoformat()
             }
             
@@ -263,31 +294,30 @@ class MemoryService:
         """
         try:
             memories = self.memory.get_all(user_id=user_id)
+            items = memories.get("results", []) if isinstance(memories, dict) else memories
             
             # 统计信息
-            total_count = len(memories)
-            
-            # 按日期统计
-            date_stats = {}
-            category_stats = {}
-            
-            for memory in memories:
-                # 日期统计
-                if 'metadata' in memory and 'timestamp' in memory['metadata']:
-                    date = memory['metadata']['timestamp'][:10]  # 取日期部分
-                    date_stats[date] = date_stats.get(date, 0) + 1
-                
-                # 分类统计
-                if 'metadata' in memory and 'category' in memory['metadata']:
-                    category = memory['metadata']['category']
-                    category_stats[category] = category_stats.get(category, 0) + 1
+            total_count = len(items)
+            
+            # 单次遍历同时统计日期和分类分布
+            date_counter = Counter()
+            category_counter = Counter()
+            
+            for memory in items:
+                metadata = memory.get('metadata') or {}
+                timestamp = metadata.get('timestamp')
+                if timestamp:
+                    date_counter[timestamp[:10]] += 1  # 取日期部分
+                category = metadata.get('category')
+                if category:
+                    category_counter[category] += 1
             
             return {
                 "success": True,
                 "user_id": user_id,
                 "total_memories": total_count,
-                "date_distribution": date_stats,
-                "category_distribution": category_stats,
+                "date_distribution": dict(date_counter),
+                "category_distribution": dict(category_counter),
                 "timestamp": datetime.now().isoformat()
             }
             
@@ -298,55 +328,3 @@ class MemoryService:
                 "message": f"获取统计信息失败: {str(e)}",
                 "error": str(e)
             }
-    
-    def batch_add_memories(self, memories_data: List[Dict[str, Any]], user_id: str) -> Dict[str, Any]:
-        """批量添加记忆
-        
-        Args:
-            memories_data: 记忆数据列表
-            user_id: 用户ID
-            
-        Returns:
-            Dict: 批量添加结果
-        """
-        results = []
-        success_count = 0
-        failed_count = 0
-        
-        for i, memory_data in enumerate(memories_data):
-            try:
-                content = memory_data.get('content', '')
-                metadata = memory_data.get('metadata', {})
-                
-                result = self.add_memory(content, user_id, metadata)
-                results.append({
-                    "index": i,
-                    "result": result
-                })
-                
-                if result['success']:
-                    success_count += 1
-                else:
-                    failed_count += 1
-                    
-            except Exception as e:
-                failed_count += 1
-                results.append({
-                    "index": i,
-                    "result": {
-                        "success": False,
-                        "message": f"处理失败: {str(e)}",
-                        "error": str(e)
-                    }
-                })
-        
-        return {
-            "success": failed_count == 0,
-            "message": f"批量添加完成，成功: {success_count}，失败: {failed_count}",
-            "user_id": user_id,
-            "total_processed": len(memories_data),
-            "success_count": success_count,
-            "failed_count": failed_count,
-            "results": results,
-            "timestamp": datetime.now().isoformat()
-        }
\ No newline at end of file
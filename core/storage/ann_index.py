@@ -0,0 +1,463 @@
+from typing import List, Dict, Any, Optional, Tuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from mem0 import Memory
+from core.storage.redis_cache import RedisVersionStore
+import functools
+import logging
+import threading
+
+import numpy as np
+
+try:
+    from usearch.index import Index as USearchIndex
+except ImportError:  # 可选依赖：优先使用 usearch 的 int8 量化索引
+    USearchIndex = None
+
+try:
+    import hnswlib
+except ImportError:  # 可选依赖：未安装时回退到 mem0 自带的向量检索
+    hnswlib = None
+
+# 与 mem0 检索结果保持一致：这些字段提升到结果顶层，其余放入 metadata
+_PROMOTED_KEYS = ("user_id", "agent_id", "run_id", "actor_id", "role")
+_CORE_KEYS = {"data", "hash", "created_at", "updated_at", "id", *_PROMOTED_KEYS}
+
+# 向量库度量（Chroma 的 hnsw:space）对应的索引度量，三者的距离定义与 Chroma 一致
+_USEARCH_METRICS = {"cosine": "cos", "l2": "l2sq", "ip": "ip"}
+_HNSWLIB_SPACES = {"cosine": "cosine", "l2": "l2", "ip": "ip"}
+
+
+def _fingerprint(payload: Dict[str, Any]) -> Tuple[Any, Any]:
+    """记忆内容的指纹：mem0 更新记忆时会同时改变 hash 和 updated_at"""
+    return payload.get("hash"), payload.get("updated_at")
+
+
+class _UserIndex:
+    """单个用户的 HNSW 索引及其标签映射
+
+    度量与向量库集合一致（Chroma 默认 l2），候选集与向量库的 top-k 相同。
+    余弦度量且安装了 usearch 时向量以 int8 量化存储（约为 float32 的 1/4 内存）；
+    其余情况存储 float32（int8 量化会截断未归一化的向量）。
+    首次写入向量时才创建底层索引，空用户也可以缓存。
+    """
+
+    def __init__(self, space: str, capacity: int, version: Optional[int]):
+        self.space = space
+        self.capacity = capacity
+        # 构建或最近一次同步时的写入版本号
+        self.version = version
+        self.quantized = USearchIndex is not None and space == "cosine"
+        self.index = None
+        self.labels: Dict[str, int] = {}
+        self.payloads: Dict[int, Tuple[str, Dict[str, Any]]] = {}
+        self.next_label = 0
+
+    def _create(self, dim: int):
+        if USearchIndex is not None:
+            # usearch 按需自动扩容，无需预留容量
+            self.index = USearchIndex(
+                ndim=dim,
+                metric=_USEARCH_METRICS[self.space],
+                dtype="i8" if self.quantized else "f32",
+                connectivity=16,
+                expansion_add=200,
+            )
+        else:
+            self.index = hnswlib.Index(space=_HNSWLIB_SPACES[self.space], dim=dim)
+            self.index.init_index(max_elements=self.capacity, ef_construction=200, M=16)
+
+    def add(self, ids: List[str], vectors: np.ndarray, payloads: List[Dict[str, Any]]):
+        if not ids:
+            return
+        if self.index is None:
+            self._create(vectors.shape[1])
+        if USearchIndex is None:
+            needed = self.next_label + len(ids)
+            capacity = self.index.get_max_elements()
+            if needed > capacity:
+                self.index.resize_index(max(needed, capacity * 2))
+
+        labels = []
+        for memory_id, payload in zip(ids, payloads):
+            label = self.next_label
+            self.next_label += 1
+            old_label = self.labels.get(memory_id)
+            if old_label is not None:
+                self._delete_label(old_label)
+            self.labels[memory_id] = label
+            self.payloads[label] = (memory_id, payload)
+            labels.append(label)
+
+        if USearchIndex is not None:
+            self.index.add(np.asarray(labels, dtype=np.uint64), vectors)
+        else:
+            self.index.add_items(vectors, labels)
+
+    def remove(self, memory_id: str) -> bool:
+        label = self.labels.pop(memory_id, None)
+        if label is None:
+            return False
+        self._delete_label(label)
+        return True
+
+    def _delete_label(self, label: int):
+        if USearchIndex is not None:
+            self.index.remove(label)
+        else:
+            self.index.mark_deleted(label)
+        self.payloads.pop(label, None)
+
+    def query(self, vector: np.ndarray, k: int, ef: int) -> List[Tuple[int, float]]:
+        """返回最相近的 (标签, 距离) 列表"""
+        if USearchIndex is not None:
+            self.index.expansion_search = ef
+            matches = self.index.search(vector, k)
+            return list(zip(matches.keys.tolist(), matches.distances.tolist()))
+        self.index.set_ef(ef)
+        labels, distances = self.index.knn_query(vector, k=k)
+        return list(zip(labels[0].tolist(), distances[0].tolist()))
+
+
+class ANNIndex:
+    """基于 HNSW 的按用户近似最近邻索引
+
+    包装 mem0 的向量存储，为每个用户在进程内维护一个 HNSW 索引，
+    把检索从随记忆数量线性增长的扫描变为亚线性查询。
+    索引由后台线程从向量库中已存储的向量构建（不重新调用嵌入接口），构建完成前
+    search 返回 None，由调用方回退到 mem0.search；之后在写入记忆时增量更新。
+    每次写入都会递增该用户的写入版本号（配置了 Redis 时跨进程共享），检索时版本号
+    与索引不一致说明有其他进程写入，此时同样回退并在后台与向量库同步。
+    """
+
+    def __init__(self, memory: Memory, initial_capacity: int = 1024,
+                 versions: Optional[RedisVersionStore] = None, max_workers: int = 2):
+        self.memory = memory
+        self.initial_capacity = initial_capacity
+        self._indexes: Dict[str, _UserIndex] = {}
+        self._owners: Dict[str, str] = {}
+        # 每个用户一把锁，只在读写索引结构时短暂持有；_lock 只保护映射表和版本号
+        self._user_locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+        # 写入版本号：未配置 Redis 时只在本进程内计数
+        self._versions = versions
+        self._local_versions: Dict[str, int] = {}
+        # 后台构建/同步任务，同一用户同时只有一个
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ann")
+        self._pending: Dict[str, Future] = {}
+        self.logger = logging.getLogger(__name__)
+
+    @property
+    def available(self) -> bool:
+        """usearch 或 hnswlib 已安装且向量库支持读取原始向量"""
+        return (USearchIndex is not None or hnswlib is not None) and hasattr(self.memory.vector_store, "collection")
+
+    def _fetch_vectors(self, user_id: str, ids: Optional[List[str]] = None) -> Tuple[List[str], np.ndarray, List[Dict[str, Any]]]:
+        """从向量库读取已存储的向量和载荷"""
+        collection = self.memory.vector_store.collection
+        if ids is not None:
+            result = collection.get(ids=ids, include=["embeddings", "metadatas"])
+        else:
+            result = collection.get(where={"user_id": user_id}, include=["embeddings", "metadatas"])
+        embeddings = result.get("embeddings")
+        if embeddings is None or len(result["ids"]) == 0:
+            return [], np.empty((0, 0), dtype=np.float32), []
+        return result["ids"], np.asarray(embeddings, dtype=np.float32), result["metadatas"]
+
+    @functools.cached_property
+    def _space(self) -> str:
+        """向量库集合使用的距离度量（l2、cosine 或 ip），Chroma 默认为 l2"""
+        collection = self.memory.vector_store.collection
+        configuration = getattr(collection, "configuration", None) or {}
+        space = (configuration.get("hnsw") or {}).get("space")
+        return space or (collection.metadata or {}).get("hnsw:space", "l2")
+
+    def _cosine_distances(self, query: np.ndarray, ids: List[str]) -> Dict[str, float]:
+        """读取候选记忆的原始向量计算精确的余弦距离（int8 量化索引的距离只是近似值）"""
+        if not ids:
+            return {}
+        result = self.memory.vector_store.collection.get(ids=ids, include=["embeddings"])
+        vectors = np.asarray(result["embeddings"], dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1) * np.linalg.norm(query)
+        distances = 1.0 - vectors @ query / np.where(norms == 0, 1.0, norms)
+        return dict(zip(result["ids"], distances.tolist()))
+
+    def _user_lock(self, user_id: str) -> threading.Lock:
+        """获取用户的索引锁"""
+        with self._lock:
+            lock = self._user_locks.get(user_id)
+            if lock is None:
+                lock = self._user_locks[user_id] = threading.Lock()
+            return lock
+
+    def _set_owners(self, user_id: str, memory_ids: List[str]):
+        with self._lock:
+            for memory_id in memory_ids:
+                self._owners[memory_id] = user_id
+
+    def _current_version(self, user_id: str) -> Optional[int]:
+        """用户当前的写入版本号，Redis 不可用时返回 None（按索引已同步处理）"""
+        if self._versions is not None:
+            return self._versions.get(user_id)
+        with self._lock:
+            return self._local_versions.get(user_id, 0)
+
+    def _bump_version(self, user_id: str) -> Optional[int]:
+        """递增用户的写入版本号并返回新值，失败时返回 None"""
+        if self._versions is not None:
+            return self._versions.incr(user_id)
+        with self._lock:
+            version = self._local_versions.get(user_id, 0) + 1
+            self._local_versions[user_id] = version
+            return version
+
+    def _schedule_sync(self, user_id: str):
+        """在后台构建或同步用户索引（已有任务在执行时跳过）"""
+        with self._lock:
+            if user_id in self._pending:
+                return
+            self._pending[user_id] = self._executor.submit(self._sync_user, user_id)
+
+    def _sync_user(self, user_id: str):
+        try:
+            if user_id in self._indexes:
+                self._refresh(user_id)
+            else:
+                self._build(user_id)
+        except Exception as e:
+            self.logger.error(f"同步用户 {user_id} 的ANN索引失败: {e}")
+        finally:
+            with self._lock:
+                self._pending.pop(user_id, None)
+
+    def _build(self, user_id: str):
+        """从向量库完整构建用户索引（不持有用户锁，检索期间继续回退到向量库）"""
+        # 先读版本号再读数据：构建期间的写入会让版本号不一致，下次检索时再同步
+        version = self._current_version(user_id)
+        ids, vectors, payloads = self._fetch_vectors(user_id)
+        index = _UserIndex(self._space, max(self.initial_capacity, len(ids)), version)
+        index.add(ids, vectors, payloads)
+        with self._user_lock(user_id):
+            self._indexes[user_id] = index
+        self._set_owners(user_id, ids)
+        self.logger.info(f"为用户 {user_id} 构建ANN索引，共 {len(ids)} 条向量")
+
+    def _refresh(self, user_id: str):
+        """与向量库比对用户的记忆，同步其他进程新增、修改或删除的记忆"""
+        version = self._current_version(user_id)
+        result = self.memory.vector_store.collection.get(where={"user_id": user_id}, include=["metadatas"])
+        current = {
+            memory_id: _fingerprint(payload)
+            for memory_id, payload in zip(result["ids"], result["metadatas"])
+        }
+        with self._user_lock(user_id):
+            index = self._indexes.get(user_id)
+            if index is None:
+                return
+            known = {
+                memory_id: _fingerprint(index.payloads[label][1])
+                for memory_id, label in index.labels.items()
+            }
+        removed = [memory_id for memory_id in known if memory_id not in current]
+        changed = [
+            memory_id for memory_id, fingerprint in current.items()
+            if known.get(memory_id) != fingerprint
+        ]
+        ids, vectors, payloads = self._fetch_vectors(user_id, changed) if changed else ([], None, [])
+
+        with self._user_lock(user_id):
+            if self._indexes.get(user_id) is not index:
+                return
+            for memory_id in removed:
+                index.remove(memory_id)
+            index.add(ids, vectors, payloads)
+            index.version = version
+        with self._lock:
+            for memory_id in removed:
+                self._owners.pop(memory_id, None)
+        self._set_owners(user_id, ids)
+        if removed or changed:
+            self.logger.info(f"同步用户 {user_id} 的ANN索引：更新 {len(changed)} 条，移除 {len(removed)} 条")
+
+    def search(self, user_id: str, query_vector: List[float], limit: int) -> Optional[List[Dict[str, Any]]]:
+        """在用户索引中检索最相近的记忆
+
+        Args:
+            user_id: 用户ID
+            query_vector: 查询向量
+            limit: 返回结果数量
+
+        Returns:
+            Optional[List[Dict]]: 与 mem0 检索结果格式一致的记忆列表；
+            索引不可用、尚未构建完成或需要同步时返回 None
+        """
+        if not self.available:
+            return None
+
+        try:
+            version = self._current_version(user_id)
+            query = np.asarray(query_vector, dtype=np.float32)
+            with self._user_lock(user_id):
+                index = self._indexes.get(user_id)
+                stale = index is None or (version is not None and index.version != version)
+                if not stale:
+                    size = len(index.payloads)
+                    if size == 0:
+                        return []
+                    # 量化索引多取一些候选，按精确距离重排后截断
+                    k = min(limit * 2 if index.quantized else limit, size)
+                    matches = index.query(query, k, max(limit * 4, 64))
+                    hits = [
+                        (*index.payloads[label], distance)
+                        for label, distance in matches if label in index.payloads
+                    ]
+            if stale:
+                self._schedule_sync(user_id)
+                return None
+            if index.quantized:
+                distances = self._cosine_distances(query, [memory_id for memory_id, _, _ in hits])
+                hits = [
+                    (memory_id, payload, distances[memory_id])
+                    for memory_id, payload, _ in hits if memory_id in distances
+                ]
+        except Exception as e:
+            self.logger.error(f"ANN检索失败，回退到向量库检索: {e}")
+            return None
+
+        # score 与 mem0 的向量库检索一致：向量库度量下的距离，越小越相近
+        items = [self._to_memory_item(memory_id, payload, distance) for memory_id, payload, distance in hits]
+        items.sort(key=lambda item: item["score"])
+        return items[:limit]
+
+    def search_text(self, user_id: str, query: str, limit: int) -> Optional[List[Dict[str, Any]]]:
+        """对查询文本生成嵌入后在用户索引中检索，索引不可用时返回 None"""
+        if not self.available:
+            return None
+        try:
+            query_vector = self.memory.embedding_model.embed(query, "search")
+        except Exception as e:
+            self.logger.error(f"生成查询向量失败: {e}")
+            return None
+        return self.search(user_id, query_vector, limit)
+
+    def _record_write(self, user_id: str, memory_ids: List[str] = (), removed: List[str] = ()):
+        """递增用户的写入版本号，并把写入增量应用到本进程的索引
+
+        索引此前已与版本号同步时，应用增量后直接推进索引的版本号；
+        否则（期间有其他进程写入）保留旧版本号，下次检索时在后台同步。
+        """
+        with self._user_lock(user_id):
+            version = self._bump_version(user_id)
+            index = self._indexes.get(user_id)
+            if index is None:
+                return
+            for memory_id in removed:
+                index.remove(memory_id)
+            if memory_ids:
+                ids, vectors, payloads = self._fetch_vectors(user_id, list(memory_ids))
+                index.add(ids, vectors, payloads)
+                self._set_owners(user_id, ids)
+            if version is not None and index.version is not None and version == index.version + 1:
+                index.version = version
+        if removed:
+            with self._lock:
+                for memory_id in removed:
+                    self._owners.pop(memory_id, None)
+
+    def add(self, user_id: str, memory_ids: List[str]):
+        """记录向量库中新增或更新的记忆（索引尚未构建时只递增版本号）
+
+        Args:
+            user_id: 用户ID
+            memory_ids: 新增或更新的记忆ID列表
+        """
+        if not self.available or not memory_ids:
+            return
+
+        try:
+            self._record_write(user_id, memory_ids=memory_ids)
+        except Exception as e:
+            self.logger.error(f"更新ANN索引失败: {e}")
+            self._drop(user_id)
+
+    def apply_add_result(self, user_id: str, result: Any):
+        """根据 mem0.add 的返回结果同步索引（ADD/UPDATE 写入，DELETE 移除）
+
+        Args:
+            user_id: 用户ID
+            result: mem0.add 的返回值
+        """
+        items = result.get("results", []) if isinstance(result, dict) else result
+        if not isinstance(items, list):
+            return
+        changed = []
+        removed = []
+        for item in items:
+            if not isinstance(item, dict) or "id" not in item:
+                continue
+            if item.get("event") == "DELETE":
+                removed.append(item["id"])
+            elif item.get("event") in ("ADD", "UPDATE"):
+                changed.append(item["id"])
+        if not self.available or not (changed or removed):
+            return
+        try:
+            self._record_write(user_id, memory_ids=changed, removed=removed)
+        except Exception as e:
+            self.logger.error(f"更新ANN索引失败: {e}")
+            self._drop(user_id)
+
+    def remove(self, memory_id: str, user_id: Optional[str] = None):
+        """从索引中移除指定记忆
+
+        Args:
+            memory_id: 记忆ID
+            user_id: 记忆所属用户；未提供时按本进程索引中的归属查找
+        """
+        if user_id is None:
+            with self._lock:
+                user_id = self._owners.get(memory_id)
+        if user_id is None:
+            return
+        try:
+            self._record_write(user_id, removed=[memory_id])
+        except Exception as e:
+            self.logger.error(f"更新ANN索引失败: {e}")
+            self._drop(user_id)
+
+    def invalidate(self, user_id: str):
+        """用户记忆被整体清除：递增版本号并丢弃索引，下次检索时重新构建"""
+        with self._user_lock(user_id):
+            self._bump_version(user_id)
+        self._drop(user_id)
+
+    def _drop(self, user_id: str):
+        """丢弃本进程中的用户索引"""
+        with self._user_lock(user_id):
+            index = self._indexes.pop(user_id, None)
+        if index is not None:
+            with self._lock:
+                for memory_id in index.labels:
+                    self._owners.pop(memory_id, None)
+
+    def close(self):
+        """停止后台构建任务"""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    @staticmethod
+    def _to_memory_item(memory_id: str, payload: Dict[str, Any], score: float) -> Dict[str, Any]:
+        """将向量库载荷转换为 mem0 检索结果格式"""
+        item = {
+            "id": memory_id,
+            "memory": payload.get("data"),
+            "hash": payload.get("hash"),
+            "created_at": payload.get("created_at"),
+            "updated_at": payload.get("updated_at"),
+            "score": score,
+        }
+        for key in _PROMOTED_KEYS:
+            if key in payload:
+                item[key] = payload[key]
+        metadata = {k: v for k, v in payload.items() if k not in _CORE_KEYS}
+        if metadata:
+            item["metadata"] = metadata
+        return item
@@ -0,0 +1,56 @@
+from typing import Any, Optional
+from cachetools import TTLCache
+from core.storage.redis_cache import RedisEmbeddingCache, stable_key
+import threading
+
+import numpy as np
+
+
+class CachedEmbedder:
+    """带查询向量缓存的嵌入器包装
+
+    替换 mem0 Memory 上的 embedding_model，对检索查询（memory_action="search"）
+    按 (规范化文本, 模型) 缓存向量，重复查询不再调用嵌入接口；
+    mem0.search 和 ANN 索引检索都经过这里，因此共享同一份缓存；
+    配置了 Redis 时作为二级缓存在多个进程间共享。
+    写入/更新时的嵌入不缓存，其余属性透传给原嵌入器。
+    """
+
+    def __init__(self, embedder: Any, maxsize: int = 4096, ttl: int = 3600, remote: Optional[RedisEmbeddingCache] = None):
+        """初始化包装器
+
+        Args:
+            embedder: mem0 的嵌入器实例
+            maxsize: 缓存的最大查询数
+            ttl: 缓存有效期（秒）
+            remote: 可选的Redis向量缓存
+        """
+        self._embedder = embedder
+        self._model = getattr(getattr(embedder, "config", None), "model", None)
+        self._cache: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        self._remote = remote
+
+    def embed(self, text: str, memory_action: Optional[str] = None):
+        """生成文本向量，检索查询优先从缓存读取"""
+        if memory_action != "search":
+            return self._embedder.embed(text, memory_action)
+
+        # 规范化查询文本以提高命中率
+        key = (text.strip().lower(), self._model)
+        with self._lock:
+            vector = self._cache.get(key)
+        if vector is None:
+            remote_key = stable_key(*key) if self._remote is not None else None
+            if remote_key is not None:
+                vector = self._remote.get(remote_key)
+            if vector is None:
+                vector = np.asarray(self._embedder.embed(text, memory_action), dtype=np.float32)
+                if remote_key is not None:
+                    self._remote.set(remote_key, vector)
+            with self._lock:
+                self._cache[key] = vector
+        return vector.tolist()
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._embedder, name)
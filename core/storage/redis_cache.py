@@ -0,0 +1,235 @@
+from typing import Any, Optional
+from config.cache import CacheConfig
+import functools
+import hashlib
+import logging
+import time
+
+import numpy as np
+import orjson
+
+try:
+    import redis
+    import redis.asyncio as aioredis
+except ImportError:  # 可选依赖：未安装时只使用进程内缓存
+    redis = None
+    aioredis = None
+
+# 未命中标记（缓存值本身可能是 None 或空列表）
+MISSING = object()
+
+# Redis连接和读写超时（秒）：Redis不可达时快速回退，不拖住请求和mem0线程
+_SOCKET_TIMEOUT = 0.25
+# Redis出错后暂停访问的时间（秒），期间直接按未命中处理
+_RETRY_DELAY = 5.0
+
+logger = logging.getLogger(__name__)
+
+
+def stable_key(*parts: Any) -> str:
+    """生成跨进程稳定的缓存键摘要（内置 hash() 每个进程的随机种子不同，不能使用）"""
+    raw = orjson.dumps(parts, default=lambda obj: type(obj).__qualname__)
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+
+class _Backoff:
+    """记录Redis故障，在 _RETRY_DELAY 秒内跳过Redis访问"""
+
+    def __init__(self):
+        self._retry_at = 0.0
+
+    @property
+    def paused(self) -> bool:
+        return time.monotonic() < self._retry_at
+
+    def failed(self, action: str, error: Exception):
+        if not self.paused:
+            logger.warning(f"{action}失败，{_RETRY_DELAY:.0f}秒内跳过Redis: {error}")
+        self._retry_at = time.monotonic() + _RETRY_DELAY
+
+
+class AsyncRedisCache:
+    """基于 redis.asyncio 的结果缓存，值使用 orjson 编码"""
+
+    def __init__(self, url: str, prefix: str = "mem0:memcache:"):
+        self.prefix = prefix
+        self._client = aioredis.Redis.from_url(
+            url, socket_connect_timeout=_SOCKET_TIMEOUT, socket_timeout=_SOCKET_TIMEOUT
+        )
+        self._backoff = _Backoff()
+
+    async def get_field(self, key: str, field: str) -> Any:
+        """读取哈希表中的一个缓存字段，未命中或 Redis 不可用时返回 MISSING"""
+        if self._backoff.paused:
+            return MISSING
+        try:
+            raw = await self._client.hget(self.prefix + key, field)
+        except Exception as e:
+            self._backoff.failed("读取Redis缓存", e)
+            return MISSING
+        return MISSING if raw is None else orjson.loads(raw)
+
+    async def set_field(self, key: str, field: str, value: Any, ttl: int):
+        """写入哈希表中的一个缓存字段并刷新整张表的过期时间，失败时忽略"""
+        if self._backoff.paused:
+            return
+        try:
+            async with self._client.pipeline(transaction=False) as pipe:
+                pipe.hset(self.prefix + key, field, orjson.dumps(value))
+                pipe.expire(self.prefix + key, ttl)
+                await pipe.execute()
+        except Exception as e:
+            self._backoff.failed("写入Redis缓存", e)
+
+    async def delete(self, key: str):
+        """删除缓存（哈希表整体删除），失败时忽略
+
+        失效操作关系到数据正确性，暂停期间也会尝试执行。
+        """
+        try:
+            await self._client.delete(self.prefix + key)
+        except Exception as e:
+            self._backoff.failed("删除Redis缓存", e)
+
+    async def get_counter(self, key: str) -> Optional[int]:
+        """读取计数器（从未写入时为 0），Redis 不可用时返回 None"""
+        if self._backoff.paused:
+            return None
+        try:
+            raw = await self._client.get(self.prefix + key)
+        except Exception as e:
+            self._backoff.failed("读取Redis计数器", e)
+            return None
+        return 0 if raw is None else int(raw)
+
+    async def incr(self, key: str) -> Optional[int]:
+        """计数器加一并返回新值，失败时返回 None
+
+        计数器用于跨进程失效，暂停期间也会尝试执行。
+        """
+        try:
+            return await self._client.incr(self.prefix + key)
+        except Exception as e:
+            self._backoff.failed("更新Redis计数器", e)
+            return None
+
+    async def close(self):
+        await self._client.aclose()
+
+
+class RedisEmbeddingCache:
+    """基于同步 Redis 客户端的查询向量缓存，向量以 float16 字节存储"""
+
+    def __init__(self, url: str, ttl: int = 86400, prefix: str = "mem0:embcache:"):
+        self.ttl = ttl
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(
+            url, socket_connect_timeout=_SOCKET_TIMEOUT, socket_timeout=_SOCKET_TIMEOUT
+        )
+        self._backoff = _Backoff()
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        if self._backoff.paused:
+            return None
+        try:
+            raw = self._client.get(self.prefix + key)
+        except Exception as e:
+            self._backoff.failed("读取Redis向量缓存", e)
+            return None
+        return None if raw is None else np.frombuffer(raw, dtype=np.float16).astype(np.float32)
+
+    def set(self, key: str, vector: np.ndarray):
+        if self._backoff.paused:
+            return
+        try:
+            self._client.setex(self.prefix + key, self.ttl, vector.astype(np.float16).tobytes())
+        except Exception as e:
+            self._backoff.failed("写入Redis向量缓存", e)
+
+    def close(self):
+        self._client.close()
+
+
+class RedisVersionStore:
+    """基于同步 Redis 客户端的按键写入版本号，用于发现其他进程的写入"""
+
+    def __init__(self, url: str, prefix: str = "mem0:version:"):
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(
+            url, socket_connect_timeout=_SOCKET_TIMEOUT, socket_timeout=_SOCKET_TIMEOUT
+        )
+        self._backoff = _Backoff()
+
+    def get(self, key: str) -> Optional[int]:
+        """读取当前版本号（从未写入时为 0），Redis 不可用时返回 None"""
+        if self._backoff.paused:
+            return None
+        try:
+            raw = self._client.get(self.prefix + key)
+        except Exception as e:
+            self._backoff.failed("读取Redis版本号", e)
+            return None
+        return 0 if raw is None else int(raw)
+
+    def incr(self, key: str) -> Optional[int]:
+        """版本号加一并返回新值，失败时返回 None
+
+        版本号关系到其他进程能否发现写入，暂停期间也会尝试执行。
+        """
+        try:
+            return self._client.incr(self.prefix + key)
+        except Exception as e:
+            self._backoff.failed("更新Redis版本号", e)
+            return None
+
+    def close(self):
+        self._client.close()
+
+
+@functools.cache
+def get_result_cache() -> Optional[AsyncRedisCache]:
+    """CACHE_BACKEND=redis 时返回共享的结果缓存，否则返回 None"""
+    config = CacheConfig.from_env()
+    if config.backend != "redis":
+        return None
+    if aioredis is None:
+        logger.warning("CACHE_BACKEND=redis 但未安装 redis，使用进程内缓存")
+        return None
+    return AsyncRedisCache(config.redis_url)
+
+
+@functools.cache
+def get_embedding_cache() -> Optional[RedisEmbeddingCache]:
+    """CACHE_BACKEND=redis 时返回共享的查询向量缓存，否则返回 None"""
+    config = CacheConfig.from_env()
+    if config.backend != "redis" or redis is None:
+        return None
+    return RedisEmbeddingCache(config.redis_url)
+
+
+@functools.cache
+def get_version_store() -> Optional[RedisVersionStore]:
+    """CACHE_BACKEND=redis 时返回共享的写入版本号存储，否则返回 None"""
+    config = CacheConfig.from_env()
+    if config.backend != "redis" or redis is None:
+        return None
+    return RedisVersionStore(config.redis_url)
+
+
+async def close_caches():
+    """关闭已创建的Redis连接"""
+    if get_result_cache.cache_info().currsize:
+        cache = get_result_cache()
+        if cache is not None:
+            await cache.close()
+        get_result_cache.cache_clear()
+    if get_embedding_cache.cache_info().currsize:
+        cache = get_embedding_cache()
+        if cache is not None:
+            cache.close()
+        get_embedding_cache.cache_clear()
+    if get_version_store.cache_info().currsize:
+        store = get_version_store()
+        if store is not None:
+            store.close()
+        get_version_store.cache_clear()
@@ -6,18 +6,26 @@ from mem0 import Memory
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, Response
 from api.router.chat import router as chat_router
 from api.router.memory import router as memory_router
-from api.dependencies import cleanup_instances
+from api.dependencies import init_instances, cleanup_instances
+from utils import clock
+from config.cache import CacheConfig
+from typing import Any, Optional
 import time
 import logging
+import orjson
+import itertools
 import asyncio
 from contextlib import asynccontextmanager
-from dotenv import load_dotenv
 import os
 
-load_dotenv()
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # 可选依赖：未安装时只使用进程内限流
+    aioredis = None
 
 # 配置日志
 logging.basicConfig(
@@ -30,77 +38,193 @@ logger = logging.getLogger(__name__)
 async def lifespan(app: FastAPI):
     """应用生命周期管理"""
     logger.info("应用启动中...")
+    await init_instances()
+    clock_task = asyncio.create_task(clock.tick())
     yield
     logger.info("应用关闭中...")
+    clock_task.cancel()
     await cleanup_instances()
+    if _RATE_LIMIT_REDIS is not None:
+        await _RATE_LIMIT_REDIS.aclose()
 
 # 创建FastAPI应用
 app = FastAPI(
     title="Memory Layer API",
     description="基于mem0的AI对话记忆功能API - 高性能版本",
     version="2.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
-# 性能监控中间件
-@app.middleware("http")
-async def performance_middleware(request: Request, call_next):
-    start_time = time.time()
+# 慢请求阈值（秒），可通过 SLOW_MS 环境变量以毫秒配置
+_SLOW_THRESHOLD = float(os.getenv("SLOW_MS", 2000)) / 1000.0
+
+# 请求序号计数器和进程标识，用于生成请求ID（多worker时按进程区分）
+_next_request_seq = itertools.count().__next__
+_PROCESS_TAG = f"{os.getpid():x}"
+
+# 不经过限流和耗时统计的路径（存活探针会频繁访问）
+_SKIP_PATHS = frozenset({"/health", "/metrics"})
+
+# 预先序列化的500响应体（请求ID在发送时拼接）
+_ERR_500_PREFIX = orjson.dumps({"detail": "内部服务器错误", "request_id": ""})[:-2]
+_ERR_500_SUFFIX = b'"}'
+
+# 限流：6个按分钟轮转的计数桶（当前分钟 + 最近5分钟，供 /metrics 统计）
+_BUCKET_COUNT = 6
+_BUCKETS = [{} for _ in range(_BUCKET_COUNT)]
+_BUCKET_MINUTES = [-1] * _BUCKET_COUNT
+# 从环境变量读取配置，提供默认值
+RATE_LIMIT = int(os.getenv("RATE_LIMIT", 100))
+
+# 预先序列化的限流响应
+_RATE_LIMITED_BODY = orjson.dumps({"detail": "请求过于频繁，请稍后重试"})
+_RATE_LIMITED_START = {
+    "type": "http.response.start",
+    "status": 429,
+    "headers": [
+        (b"content-type", b"application/json"),
+        (b"content-length", str(len(_RATE_LIMITED_BODY)).encode()),
+    ],
+}
+_RATE_LIMITED_BODY_MESSAGE = {"type": "http.response.body", "body": _RATE_LIMITED_BODY}
+
+# CACHE_BACKEND=redis 时限流计数也放到Redis，多worker共享
+_cache_config = CacheConfig.from_env()
+RATE_LIMIT_REDIS_URL = _cache_config.redis_url if _cache_config.backend == "redis" else None
+# Redis操作超时（秒）和故障后的重试间隔（秒）：Redis不可达时快速回退到进程内计数
+_REDIS_TIMEOUT = 0.25
+_REDIS_RETRY_DELAY = 5.0
+_RATE_LIMIT_REDIS = aioredis.Redis.from_url(
+    RATE_LIMIT_REDIS_URL,
+    socket_connect_timeout=_REDIS_TIMEOUT,
+    socket_timeout=_REDIS_TIMEOUT
+) if RATE_LIMIT_REDIS_URL and aioredis is not None else None
+# 全局请求数和客户端数的保留时间，覆盖 /metrics 统计的分钟数
+_METRICS_TTL = _BUCKET_COUNT * 60
+
+class CombinedHotPathMiddleware:
+    """热路径中间件（纯ASGI实现）：限流 + 请求ID + 耗时统计合并为一层
     
-    # 添加请求ID
-    request_id = f"{int(time.time() * 1000)}-{hash(str(request.url)) % 10000}"
+    每个请求只经过一次调用和一个send包装。限流直接读取scope中的客户端地址，
+    超限时手写429响应；配置了Redis时在多个worker间共享计数（一次管道往返），
+    Redis不可用时回退到进程内计数，并在 _REDIS_RETRY_DELAY 秒后再尝试Redis。
+    """
     
-    try:
-        response = await call_next(request)
-        process_time = time.time() - start_time
+    def __init__(self, app, limit: int, redis: Optional[Any] = None, slow_threshold: float = _SLOW_THRESHOLD):
+        self.app = app
+        self.limit = limit
+        self.slow_threshold = slow_threshold
+        self._redis = redis
+        self._redis_ok = True
+        self._redis_retry_at = 0.0
+    
+    async def __call__(self, scope, receive, send):
+        # 探活和监控请求不做限流和耗时统计
+        if scope["type"] != "http" or scope["path"] in _SKIP_PATHS:
+            await self.app(scope, receive, send)
+            return
         
-        # 添加性能头
-        response.headers["X-Process-Time"] = str(process_time)
-        response.headers["X-Request-ID"] = request_id
+        now = time.time()
         
-        # 记录慢请求
-        if process_time > 2.0:
-            logger.warning(f"慢请求检测: {request.method} {request.url} - {process_time:.2f}s")
+        # 限流检查（按分钟计数）
+        client = scope.get("client")
+        client_ip = client[0] if client else ""
+        current_time = int(now / 60)
         
-        return response
+        count = None
+        if self._redis is not None and time.monotonic() >= self._redis_retry_at:
+            count = await self._count_redis(client_ip, current_time)
+        if count is None:
+            count = self._count_local(client_ip, current_time)
+        if count > self.limit:
+            await send(_RATE_LIMITED_START)
+            await send(_RATE_LIMITED_BODY_MESSAGE)
+            return
         
-    except Exception as e:
-        process_time = time.time() - start_time
-        logger.error(f"请求处理失败: {request.method} {request.url} - {process_time:.2f}s - {str(e)}")
-        return JSONResponse(
-            status_code=500,
-            content={"detail": "内部服务器错误", "request_id": request_id},
-            headers={"X-Request-ID": request_id}
-        )
-
-# 限流中间件
-request_counts = {}
-# 从环境变量读取配置，提供默认值
-RATE_LIMIT = int(os.getenv("RATE_LIMIT", 100))
-
-@app.middleware("http")
-async def rate_limit_middleware(request: Request, call_next):
-    client_ip = request.client.host
-    current_time = int(time.time() / 60)  # 按分钟计算
-    
-    key = f"{client_ip}:{current_time}"
-    
-    if key in request_counts:
-        request_counts[key] += 1
-        if request_counts[key] > RATE_LIMIT:
-            return JSONResponse(
-                status_code=429,
-                content={"detail": "请求过于频繁，请稍后重试"}
-            )
-    else:
-        request_counts[key] = 1
+        # 耗时统计使用单调时钟，不受系统时间调整影响
+        start_time = time.perf_counter()
+        
+        # 添加请求ID（毫秒时间戳 + 进程标识 + 进程内自增序号，无需对URL做哈希）
+        request_id = f"{int(now * 1000):x}-{_PROCESS_TAG}-{_next_request_seq():x}"
+        response_started = False
+        slow_threshold = self.slow_threshold
+        
+        async def send_wrapper(message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+                process_time = time.perf_counter() - start_time
+                
+                # 添加性能头
+                headers = list(message.get("headers", ()))
+                headers.append((b"x-process-time", str(process_time).encode()))
+                headers.append((b"x-request-id", request_id.encode()))
+                message["headers"] = headers
+                
+                # 记录慢请求
+                if process_time > slow_threshold:
+                    logger.warning(f"慢请求检测: {scope['method']} {scope['path']} - {process_time:.2f}s")
+            await send(message)
+        
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except Exception as e:
+            process_time = time.perf_counter() - start_time
+            logger.error(f"请求处理失败: {scope['method']} {scope['path']} - {process_time:.2f}s - {str(e)}")
+            if response_started:
+                raise
+            # 请求ID只含十六进制数字和"-"，可直接拼入预先序列化的响应体
+            rid = request_id.encode()
+            body = _ERR_500_PREFIX + rid + _ERR_500_SUFFIX
+            await send({
+                "type": "http.response.start",
+                "status": 500,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode()),
+                    (b"x-request-id", rid),
+                ],
+            })
+            await send({"type": "http.response.body", "body": body})
     
-    # 清理旧的计数
-    old_keys = [k for k in request_counts.keys() if int(k.split(':')[1]) < current_time - 5]
-    for old_key in old_keys:
-        del request_counts[old_key]
+    async def _count_redis(self, client_ip: str, current_time: int) -> Optional[int]:
+        """在Redis中累加计数（同时记录供 /metrics 使用的全局请求数和客户端数），失败时返回 None"""
+        try:
+            async with self._redis.pipeline(transaction=False) as pipe:
+                key = f"rl:{client_ip}:{current_time}"
+                pipe.incr(key)
+                pipe.expire(key, 60)
+                pipe.incr(f"rl:total:{current_time}")
+                pipe.expire(f"rl:total:{current_time}", _METRICS_TTL)
+                pipe.pfadd(f"rl:clients:{current_time}", client_ip)
+                pipe.expire(f"rl:clients:{current_time}", _METRICS_TTL)
+                count = (await pipe.execute())[0]
+        except Exception as e:
+            if self._redis_ok:
+                logger.warning(f"Redis限流不可用，回退到进程内计数: {e}")
+                self._redis_ok = False
+            self._redis_retry_at = time.monotonic() + _REDIS_RETRY_DELAY
+            return None
+        self._redis_ok = True
+        return count
     
-    return await call_next(request)
+    @staticmethod
+    def _count_local(client_ip: str, current_time: int) -> int:
+        """在进程内的分钟桶中累加计数"""
+        # 进入新的一分钟时清空对应的桶，无需扫描旧计数
+        index = current_time % _BUCKET_COUNT
+        if _BUCKET_MINUTES[index] != current_time:
+            _BUCKETS[index].clear()
+            _BUCKET_MINUTES[index] = current_time
+        
+        bucket = _BUCKETS[index]
+        count = bucket.get(client_ip, 0) + 1
+        bucket[client_ip] = count
+        return count
+
+# 注册在TrustedHost/CORS之前（位于其内层），CORS仍负责处理预检请求
+app.add_middleware(CombinedHotPathMiddleware, limit=RATE_LIMIT, redis=_RATE_LIMIT_REDIS)
 
 # 安全中间件
 allowed_hosts_str = os.getenv("ALLOWED_HOSTS", "*")
@@ -110,6 +234,9 @@ app.add_middleware(
     allowed_hosts=allowed_hosts
 )
 
+# 压缩中间件（只压缩超过1KB的响应；注册在CORS之前，位于其内层）
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
 # CORS中间件
 allowed_origins_str = os.getenv("ALLOWED_ORIGINS", "*")
 allowed_origins = [o.strip() for o in allowed_origins_str.split(',')]
@@ -117,48 +244,77 @@ app.add_middleware(
     CORSMiddleware,
     allow_origins=allowed_origins,
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-    expose_headers=["X-Process-Time", "X-Request-ID"]
+    # 显式列出方法和请求头，并让浏览器缓存预检结果一天，减少OPTIONS请求
+    allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
+    allow_headers=["Content-Type", "Authorization", "X-Request-ID"],
+    expose_headers=["X-Process-Time", "X-Request-ID"],
+    max_age=86400
 )
 
 # 注册路由
 app.include_router(chat_router, prefix="/api")
 app.include_router(memory_router, prefix="/api")
 
+# 根路径内容固定不变，启动时序列化一次，请求时直接返回字节
+_ROOT_BYTES = orjson.dumps({
+    "message": "Memory Layer API v2.0 - 高性能版本", 
+    "docs": "/docs",
+    "services": {
+        "chat": "/api/chat",
+        "memory": "/api/memory"
+    },
+    "features": [
+        "异步处理",
+        "连接池优化",
+        "智能缓存",
+        "性能监控",
+        "限流保护"
+    ]
+})
+
 @app.get("/")
 async def root():
-    return {
-        "message": "Memory Layer API v2.0 - 高性能版本", 
-        "docs": "/docs",
-        "services": {
-            "chat": "/api/chat",
-            "memory": "/api/memory"
-        },
-        "features": [
-            "异步处理",
-            "连接池优化",
-            "智能缓存",
-            "性能监控",
-            "限流保护"
-        ]
-    }
+    return Response(content=_ROOT_BYTES, media_type="application/json")
 
-@app.get("/health")
-async def health_check():
-    """健康检查端点"""
-    return {
-        "status": "healthy",
-        "timestamp": time.time(),
-        "version": "2.0.0"
-    }
+# 健康检查响应体的固定部分预先序列化，只拼接时间戳
+_HEALTH_PREFIX = b'{"status":"healthy","timestamp":'
+_HEALTH_SUFFIX = b',"version":"2.0.0"}'
+
+async def health_check(request):
+    """健康检查端点（普通Starlette路由，不经过FastAPI的参数解析和响应序列化）"""
+    return Response(
+        content=_HEALTH_PREFIX + repr(time.time()).encode() + _HEALTH_SUFFIX,
+        media_type="application/json"
+    )
+
+app.add_route("/health", health_check, methods=["GET"])
 
 @app.get("/metrics")
 async def get_metrics():
-    """获取性能指标"""
+    """获取性能指标（Redis限流时统计所有worker，否则统计本进程）"""
+    current_time = int(time.time() / 60)
+    if _RATE_LIMIT_REDIS is not None:
+        minutes = range(current_time - _BUCKET_COUNT + 1, current_time + 1)
+        try:
+            async with _RATE_LIMIT_REDIS.pipeline(transaction=False) as pipe:
+                for minute in minutes:
+                    pipe.get(f"rl:total:{minute}")
+                    pipe.pfcount(f"rl:clients:{minute}")
+                values = await pipe.execute()
+            return {
+                "active_connections": sum(values[1::2]),
+                "total_requests": sum(int(total or 0) for total in values[0::2]),
+                "timestamp": time.time()
+            }
+        except Exception as e:
+            logger.warning(f"读取Redis限流统计失败，返回本进程统计: {e}")
+    buckets = [
+        bucket for bucket, minute in zip(_BUCKETS, _BUCKET_MINUTES)
+        if minute > current_time - _BUCKET_COUNT
+    ]
     return {
-        "active_connections": len(request_counts),
-        "total_requests": sum(request_counts.values()),
+        "active_connections": sum(len(bucket) for bucket in buckets),
+        "total_requests": sum(sum(bucket.values()) for bucket in buckets),
         "timestamp": time.time()
     }
 
@@ -167,18 +323,41 @@ async def get_metrics():
 @app.exception_handler(Exception)
 async def generic_exception_handler(request: Request, exc: Exception):
     logger.error(f"Unhandled exception for {request.method} {request.url}: {exc}", exc_info=True)
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=500,
         content={"detail": "An internal server error occurred.", "error": str(exc)},
     )
 
+def _redis_reachable(url: Optional[str]) -> bool:
+    """检查Redis是否可用"""
+    if not url or aioredis is None:
+        return False
+    try:
+        import redis
+        redis.Redis.from_url(url, socket_connect_timeout=2).ping()
+        return True
+    except Exception as e:
+        logger.warning(f"无法连接Redis: {e}")
+        return False
+
 if __name__ == "__main__":
     import uvicorn
+    # 默认单进程：会话历史、待保存的对话、ANN索引和本地缓存都在进程内，
+    # 多进程时同一会话的连续请求可能落到不同worker而丢失上下文
+    workers = int(os.getenv("WORKERS", "1"))
+    if workers > 1:
+        logger.warning("WORKERS>1：会话历史和进程内缓存不在worker间共享，同一会话的请求可能丢失上下文")
+        if not _redis_reachable(RATE_LIMIT_REDIS_URL):
+            logger.warning("Redis不可用，限流计数按worker分别统计")
     uvicorn.run(
-        app, 
+        "main:app", 
         host="0.0.0.0", 
         port=8000,
-        workers=1,  # 单进程，因为我们使用了全局状态
-        loop="asyncio",
-        access_log=True
+        workers=workers,
+        loop="auto",  # 已安装uvloop时自动使用（Windows上回退到asyncio）
+        http="httptools",
+        backlog=2048,  # 突发连接时加大监听队列
+        limit_concurrency=1000,  # 每个worker的并发上限，超出时直接返回503
+        timeout_keep_alive=30,
+        access_log=False  # 慢请求已由热路径中间件记录
     )
@@ -0,0 +1,271 @@
+"""ANNIndex 单元测试：使用内存中的 Chroma 集合，不需要 Azure 或 Redis
+
+运行：python -m unittest test_ann_index
+"""
+import threading
+import unittest
+import uuid
+from types import SimpleNamespace
+from unittest import mock
+
+import chromadb
+import numpy as np
+
+from core.storage import ann_index
+from core.storage.ann_index import ANNIndex
+
+_CLIENT = chromadb.EphemeralClient()
+_DIM = 16
+
+
+class _Versions:
+    """进程间共享的版本号存储（代替 RedisVersionStore）"""
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._values.get(key, 0)
+
+    def incr(self, key):
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + 1
+            return self._values[key]
+
+
+class _CountingCollection:
+    """记录 get 调用次数的集合代理"""
+
+    def __init__(self, collection):
+        self._collection = collection
+        self.gets = 0
+
+    def get(self, *args, **kwargs):
+        self.gets += 1
+        return self._collection.get(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
+
+
+def _memory(space="l2"):
+    metadata = None if space == "l2" else {"hnsw:space": space}
+    collection = _CLIENT.create_collection(f"ann-{uuid.uuid4().hex[:12]}", metadata=metadata)
+    return SimpleNamespace(vector_store=SimpleNamespace(collection=collection))
+
+
+def _insert(memory, user_id, vectors, text="memory"):
+    ids = [uuid.uuid4().hex for _ in vectors]
+    memory.vector_store.collection.add(
+        ids=ids,
+        embeddings=[v.tolist() for v in vectors],
+        metadatas=[{"user_id": user_id, "data": f"{text} {i}", "hash": uuid.uuid4().hex} for i in range(len(vectors))],
+    )
+    return ids
+
+
+def _wait(index, user_id):
+    future = index._pending.get(user_id)
+    if future is not None:
+        future.result(timeout=30)
+
+
+def _ready(index, user_id):
+    """首次检索触发后台构建，等待构建完成"""
+    assert index.search(user_id, np.zeros(_DIM).tolist(), 1) is None
+    _wait(index, user_id)
+
+
+def _chroma_top(memory, user_id, query, k):
+    result = memory.vector_store.collection.query(
+        query_embeddings=[query.tolist()], n_results=k, where={"user_id": user_id}
+    )
+    return result["ids"][0], result["distances"][0]
+
+
+class ANNIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.default_rng(7)
+
+    def _vectors(self, n, scale=10.0):
+        # 未归一化的向量：l2 与余弦的近邻不同
+        return (self.rng.standard_normal((n, _DIM)) * self.rng.uniform(0.1, scale, (n, 1))).astype(np.float32)
+
+    def test_first_search_builds_in_background_and_falls_back(self):
+        memory = _memory()
+        _insert(memory, "alice", self._vectors(200))
+        index = ANNIndex(memory)
+        query = self._vectors(1)[0]
+
+        self.assertIsNone(index.search("alice", query.tolist(), 5))
+        _wait(index, "alice")
+        items = index.search("alice", query.tolist(), 5)
+
+        ids, distances = _chroma_top(memory, "alice", query, 5)
+        self.assertEqual([item["id"] for item in items], ids)
+        np.testing.assert_allclose([item["score"] for item in items], distances, rtol=1e-3)
+        self.assertTrue(all(item["user_id"] == "alice" for item in items))
+
+    def test_hnswlib_backend_uses_collection_metric(self):
+        with mock.patch.object(ann_index, "USearchIndex", None):
+            self.test_first_search_builds_in_background_and_falls_back()
+
+    def test_cosine_collection_matches_chroma(self):
+        memory = _memory("cosine")
+        _insert(memory, "alice", self._vectors(200))
+        index = ANNIndex(memory)
+        _ready(index, "alice")
+        query = self._vectors(1)[0]
+
+        items = index.search("alice", query.tolist(), 5)
+
+        ids, distances = _chroma_top(memory, "alice", query, 5)
+        self.assertEqual([item["id"] for item in items], ids)
+        np.testing.assert_allclose([item["score"] for item in items], distances, rtol=1e-3, atol=1e-5)
+
+    def test_repeated_search_does_not_read_the_collection(self):
+        memory = _memory()
+        _insert(memory, "alice", self._vectors(50))
+        index = ANNIndex(memory)
+        _ready(index, "alice")
+        memory.vector_store.collection = collection = _CountingCollection(memory.vector_store.collection)
+
+        for _ in range(20):
+            self.assertIsNotNone(index.search("alice", self._vectors(1)[0].tolist(), 5))
+
+        self.assertEqual(collection.gets, 0)
+        self.assertEqual(index._pending, {})
+
+    def test_user_without_memories_returns_empty(self):
+        memory = _memory()
+        index = ANNIndex(memory)
+        _ready(index, "nobody")
+
+        self.assertEqual(index.search("nobody", self._vectors(1)[0].tolist(), 5), [])
+
+    def test_add_and_remove_update_the_index(self):
+        memory = _memory()
+        _insert(memory, "alice", self._vectors(30))
+        index = ANNIndex(memory)
+        _ready(index, "alice")
+        target = self._vectors(1)[0]
+
+        [new_id] = _insert(memory, "alice", [target])
+        index.add("alice", [new_id])
+        items = index.search("alice", target.tolist(), 1)
+        self.assertEqual(items[0]["id"], new_id)
+        self.assertAlmostEqual(items[0]["score"], 0.0, places=4)
+
+        memory.vector_store.collection.delete(ids=[new_id])
+        index.remove(new_id, "alice")
+        items = index.search("alice", target.tolist(), 5)
+        self.assertNotIn(new_id, [item["id"] for item in items])
+
+    def test_apply_add_result_handles_mem0_events(self):
+        memory = _memory()
+        old_ids = _insert(memory, "alice", self._vectors(5))
+        index = ANNIndex(memory)
+        _ready(index, "alice")
+        target = self._vectors(1)[0]
+
+        [new_id] = _insert(memory, "alice", [target])
+        memory.vector_store.collection.delete(ids=[old_ids[0]])
+        index.apply_add_result("alice", {"results": [
+            {"id": new_id, "event": "ADD"},
+            {"id": old_ids[0], "event": "DELETE"},
+        ]})
+
+        ids = [item["id"] for item in index.search("alice", target.tolist(), 10)]
+        self.assertEqual(ids[0], new_id)
+        self.assertNotIn(old_ids[0], ids)
+
+    def test_writes_from_another_process_trigger_a_background_refresh(self):
+        memory = _memory()
+        ids = _insert(memory, "alice", self._vectors(30))
+        versions = _Versions()
+        local = ANNIndex(memory, versions=versions)
+        other = ANNIndex(memory, versions=versions)
+        _ready(local, "alice")
+        target = self._vectors(1)[0]
+
+        # 另一个进程新增、更新和删除记忆（它没有构建该用户的索引，只递增版本号）
+        [new_id] = _insert(memory, "alice", [target])
+        other.add("alice", [new_id])
+        memory.vector_store.collection.update(
+            ids=[ids[0]], embeddings=[(target + 0.01).tolist()],
+            metadatas=[{"user_id": "alice", "data": "updated", "hash": "changed"}],
+        )
+        other.add("alice", [ids[0]])
+        memory.vector_store.collection.delete(ids=[ids[1]])
+        other.remove(ids[1], "alice")
+
+        self.assertIsNone(local.search("alice", target.tolist(), 5))
+        _wait(local, "alice")
+        items = local.search("alice", target.tolist(), 31)
+
+        found = {item["id"]: item for item in items}
+        self.assertEqual(items[0]["id"], new_id)
+        self.assertEqual(found[ids[0]]["memory"], "updated")
+        self.assertNotIn(ids[1], found)
+        self.assertEqual(len(items), 30)
+
+    def test_write_during_build_is_picked_up(self):
+        memory = _memory()
+        _insert(memory, "alice", self._vectors(10))
+        index = ANNIndex(memory)
+        target = self._vectors(1)[0]
+        fetch = index._fetch_vectors
+        added = []
+
+        def fetch_then_write(user_id, ids=None):
+            # 构建读取快照之后、安装索引之前发生写入
+            result = fetch(user_id, ids)
+            if ids is None and not added:
+                added.extend(_insert(memory, "alice", [target]))
+                index.add("alice", added)
+            return result
+
+        with mock.patch.object(index, "_fetch_vectors", fetch_then_write):
+            _ready(index, "alice")
+        self.assertIsNone(index.search("alice", target.tolist(), 1))
+        _wait(index, "alice")
+
+        self.assertEqual(index.search("alice", target.tolist(), 1)[0]["id"], added[0])
+
+    def test_invalidate_rebuilds_in_background(self):
+        memory = _memory()
+        ids = _insert(memory, "alice", self._vectors(10))
+        index = ANNIndex(memory)
+        _ready(index, "alice")
+
+        memory.vector_store.collection.delete(ids=ids)
+        index.invalidate("alice")
+
+        self.assertIsNone(index.search("alice", self._vectors(1)[0].tolist(), 5))
+        _wait(index, "alice")
+        self.assertEqual(index.search("alice", self._vectors(1)[0].tolist(), 5), [])
+
+    def test_unavailable_vector_store_falls_back(self):
+        index = ANNIndex(SimpleNamespace(vector_store=SimpleNamespace()))
+
+        self.assertIsNone(index.search("alice", self._vectors(1)[0].tolist(), 5))
+        self.assertEqual(index._pending, {})
+
+    def test_failed_build_falls_back_and_retries(self):
+        memory = _memory()
+        _insert(memory, "alice", self._vectors(10))
+        index = ANNIndex(memory)
+
+        with mock.patch.object(index, "_fetch_vectors", side_effect=RuntimeError("down")):
+            _ready(index, "alice")
+        self.assertIsNone(index.search("alice", self._vectors(1)[0].tolist(), 5))
+        _wait(index, "alice")
+
+        self.assertEqual(len(index.search("alice", self._vectors(1)[0].tolist(), 5)), 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
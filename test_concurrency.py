@@ -0,0 +1,244 @@
+"""并发路径单元测试：检索缓存、请求去重、熔断器和批量写入，不需要 Azure 或 Redis
+
+运行：python -m unittest test_concurrency
+"""
+import asyncio
+import logging
+import time
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from core import agent
+from core.agent import CircuitBreaker, CircuitOpenError, MemoryAgent, async_cache
+from core.memory_batch_writer import MemoryBatchWriter
+from core.storage.redis_cache import MISSING
+
+
+class _RemoteCache:
+    """进程间共享的结果缓存（代替 AsyncRedisCache）"""
+
+    def __init__(self):
+        self.hashes = {}
+        self.counters = {}
+
+    async def get_field(self, key, field):
+        return self.hashes.get(key, {}).get(field, MISSING)
+
+    async def set_field(self, key, field, value, ttl):
+        self.hashes.setdefault(key, {})[field] = value
+
+    async def delete(self, key):
+        self.hashes.pop(key, None)
+
+    async def get_counter(self, key):
+        return self.counters.get(key, 0)
+
+    async def incr(self, key):
+        self.counters[key] = self.counters.get(key, 0) + 1
+        return self.counters[key]
+
+
+def _cached_loader(release: asyncio.Event, calls=None):
+    """返回按用户缓存的加载函数和调用记录，每次加载等待 release 后返回累计调用次数"""
+    calls = [] if calls is None else calls
+
+    @async_cache(ttl_seconds=60, scope_arg=0)
+    async def load(user_id):
+        calls.append(user_id)
+        await release.wait()
+        return len(calls)
+
+    return load, calls
+
+
+class AsyncCacheTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_concurrent_miss_then_invalidate_reloads(self):
+        release = asyncio.Event()
+        load, calls = _cached_loader(release)
+
+        first = [asyncio.create_task(load("alice")) for _ in range(3)]
+        await asyncio.sleep(0)
+        await load.invalidate("alice")
+        release.set()
+
+        # 并发的相同未命中只执行一次；失效前发起的结果不会在失效后继续命中
+        self.assertEqual(await asyncio.gather(*first), [1, 1, 1])
+        self.assertEqual(await load("alice"), 2)
+        self.assertEqual(await load("alice"), 2)
+        self.assertEqual(len(calls), 2)
+
+    async def test_invalidation_reaches_other_workers_through_redis(self):
+        remote = _RemoteCache()
+        release = asyncio.Event()
+        release.set()
+        with mock.patch.object(agent, "get_result_cache", return_value=remote):
+            # 两个 worker 各自有本地缓存，共享同一个 Redis
+            worker_a, calls = _cached_loader(release)
+            worker_b, _ = _cached_loader(release, calls)
+
+            self.assertEqual(await worker_a("alice"), 1)
+            self.assertEqual(await worker_b("alice"), 1)
+            await worker_a.invalidate("alice")
+
+            self.assertEqual(await worker_b("alice"), 2)
+            self.assertEqual(len(calls), 2)
+
+    async def test_result_loaded_across_invalidation_is_not_shared(self):
+        remote = _RemoteCache()
+        release = asyncio.Event()
+        with mock.patch.object(agent, "get_result_cache", return_value=remote):
+            load, _ = _cached_loader(release)
+
+            task = asyncio.create_task(load("alice"))
+            await asyncio.sleep(0)
+            await load.invalidate("alice")
+            release.set()
+            await task
+
+            self.assertEqual(remote.hashes, {})
+
+
+class DedupTest(unittest.IsolatedAsyncioTestCase):
+
+    def _agent(self, retrieve):
+        memory_agent = MemoryAgent.__new__(MemoryAgent)
+        memory_agent._pending_requests = {}
+        memory_agent.logger = logging.getLogger(agent.__name__)
+        memory_agent._get_relevant_memories_cached = retrieve
+        return memory_agent
+
+    async def test_joiner_of_failed_retrieval_gets_empty_result(self):
+        started = asyncio.Event()
+        fail = asyncio.Event()
+
+        async def retrieve(user_id, query, limit):
+            started.set()
+            await fail.wait()
+            raise RuntimeError("vector store down")
+
+        memory_agent = self._agent(retrieve)
+        owner = asyncio.create_task(memory_agent._get_relevant_memories_with_dedup("alice", "q"))
+        await started.wait()
+        joiner = asyncio.create_task(memory_agent._get_relevant_memories_with_dedup("alice", "q"))
+        await asyncio.sleep(0)
+        fail.set()
+
+        with self.assertLogs(agent.__name__, logging.ERROR):
+            self.assertEqual(await asyncio.gather(owner, joiner), [[], []])
+        self.assertEqual(memory_agent._pending_requests, {})
+
+
+class CircuitBreakerTest(unittest.IsolatedAsyncioTestCase):
+
+    async def _fail(self):
+        raise RuntimeError("down")
+
+    async def test_half_open_allows_a_single_probe(self):
+        breaker = CircuitBreaker(failure_threshold=1, timeout=0)
+        with self.assertRaises(RuntimeError):
+            await breaker.call(self._fail)
+        self.assertEqual(breaker.state, 'OPEN')
+
+        release = asyncio.Event()
+        calls = []
+
+        async def probe():
+            calls.append(1)
+            await release.wait()
+            return "ok"
+
+        time.sleep(0.001)
+        first = asyncio.create_task(breaker.call(probe))
+        await asyncio.sleep(0)
+        self.assertEqual(breaker.state, 'HALF_OPEN')
+        # 试探请求结束前其余请求快速失败
+        with self.assertRaises(CircuitOpenError):
+            await breaker.call(probe)
+
+        release.set()
+        self.assertEqual(await first, "ok")
+        self.assertEqual(breaker.state, 'CLOSED')
+        self.assertEqual(await breaker.call(probe), "ok")
+        self.assertEqual(len(calls), 2)
+
+    async def test_cancelled_probe_releases_the_slot(self):
+        breaker = CircuitBreaker(failure_threshold=1, timeout=0)
+        with self.assertRaises(RuntimeError):
+            await breaker.call(self._fail)
+        time.sleep(0.001)
+
+        probe = asyncio.create_task(breaker.call(asyncio.sleep, 10))
+        await asyncio.sleep(0)
+        probe.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await probe
+
+        self.assertIsNone(await breaker.call(asyncio.sleep, 0))
+
+
+class _Embeddings:
+    """记录每次请求输入数的嵌入接口，包含 bad 的输入被拒绝"""
+
+    def __init__(self):
+        self.calls = []
+
+    def create(self, input, model):
+        self.calls.append(len(input))
+        if any("bad" in text for text in input):
+            raise ValueError("input rejected")
+        return SimpleNamespace(data=[SimpleNamespace(embedding=[float(len(text))]) for text in input])
+
+
+def _writer_memory(embeddings):
+    inserted = []
+    memory = SimpleNamespace(
+        embedding_model=SimpleNamespace(
+            client=SimpleNamespace(embeddings=embeddings), config=SimpleNamespace(model="embedding")
+        ),
+        vector_store=SimpleNamespace(insert=lambda vectors, ids, payloads: inserted.extend(ids)),
+        db=SimpleNamespace(add_history=lambda *args, **kwargs: None),
+    )
+    return memory, inserted
+
+
+class BatchWriterTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_failing_request_does_not_fail_others_in_the_window(self):
+        embeddings = _Embeddings()
+        memory, inserted = _writer_memory(embeddings)
+        writer = MemoryBatchWriter(memory, flush_interval=0.05)
+        writer.start()
+        try:
+            with self.assertLogs("core.memory_batch_writer", logging.ERROR):
+                good, bad, other = await asyncio.gather(
+                    writer.submit([{"content": "likes tea"}, {"content": "lives in Paris"}], "alice"),
+                    writer.submit([{"content": "bad input"}], "bob"),
+                    writer.submit([{"content": "plays chess"}], "carol"),
+                )
+        finally:
+            await writer.stop()
+
+        self.assertEqual((good["success_count"], good["failed_count"]), (2, 0))
+        self.assertEqual((other["success_count"], other["failed_count"]), (1, 0))
+        self.assertEqual((bad["success_count"], bad["failed_count"]), (0, 1))
+        self.assertIn("input rejected", bad["results"][0]["result"]["error"])
+        self.assertEqual(len(inserted), 3)
+
+    async def test_embedding_calls_are_chunked(self):
+        embeddings = _Embeddings()
+        memory, inserted = _writer_memory(embeddings)
+        writer = MemoryBatchWriter(memory, max_batch=4)
+
+        [result] = await asyncio.to_thread(
+            writer._write_batch, [([{"content": f"memory {i}"} for i in range(10)], "alice")]
+        )
+
+        self.assertEqual(embeddings.calls, [4, 4, 2])
+        self.assertEqual(result["success_count"], 10)
+        self.assertEqual(len(inserted), 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
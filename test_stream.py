@@ -4,21 +4,72 @@
 用于测试 mem0 长记忆对话系统的流式输出功能
 """
 
-import requests
-import json
+import httpx
+import orjson
 import time
 import sys
-from typing import Optional
+from typing import Iterator, List, Optional
+
+def _iter_lines(response: httpx.Response, chunk_size: int = 4096) -> Iterator[bytes]:
+    """按块读取响应并在同一个bytearray中切分行，避免逐行解码为str"""
+    buf = bytearray()
+    for chunk in response.iter_bytes(chunk_size=chunk_size):
+        buf.extend(chunk)
+        while (i := buf.find(b"\n")) != -1:
+            line = bytes(buf[:i])
+            del buf[:i + 1]
+            yield line
+    if buf:
+        yield bytes(buf)
+
+# 流式事件处理函数：参数为 (事件数据, 已收到的内容片段)，返回 _DONE 表示流结束
+_DONE = "DONE"
+
+def _noop(data: dict, content_buffer: List[str]):
+    return None
+
+def _h_meta(data: dict, content_buffer: List[str]):
+    print(f"📋 元数据信息:")
+    print(f"   用户ID: {data['user_id']}")
+    print(f"   会话ID: {data['session_id']}")
+    print(f"   使用记忆: {data['memories_used']}")
+    print(f"   时间戳: {data['timestamp']}")
+    print("\n🤖 AI回复:")
+
+def _h_content(data: dict, content_buffer: List[str]):
+    content = data["content"]
+    content_buffer.append(content)
+    print(content, end='', flush=True)
+
+def _h_content_pretty(data: dict, content_buffer: List[str]):
+    content = data["content"]
+    content_buffer.append(content)
+    # 逐字打印，模拟打字机效果（仅用于演示，会掩盖真实的服务端延迟）
+    for char in content:
+        print(char, end='', flush=True)
+        time.sleep(0.02)
+
+def _h_done(data: dict, content_buffer: List[str]):
+    print("\n")
+    print("-" * 50)
+    print(f"✅ 流式输出完成!")
+    print(f"📝 完整回复: {''.join(content_buffer)}")
+    return _DONE
+
+# 按事件类型分派，每帧只做一次字典查找
+_HANDLERS = {"metadata": _h_meta, "content": _h_content, "done": _h_done}
+_PRETTY_HANDLERS = {**_HANDLERS, "content": _h_content_pretty}
 
 class StreamChatClient:
-    def __init__(self, base_url: str = "http://localhost:8000"):
+    def __init__(self, base_url: str = "http://localhost:8000", pretty: bool = False):
         self.base_url = base_url
-        self.session = requests.Session()
+        self.pretty = pretty
+        # 复用连接池；服务端支持时（如经TLS反向代理）通过HTTP/2多路复用
+        self.session = httpx.Client(base_url=base_url, http2=True, timeout=60.0)
     
     def stream_chat(self, user_id: str, message: str, session_id: Optional[str] = None):
         """发送流式对话请求并实时打印结果"""
         
-        url = f"{self.base_url}/api/chat/message"
         data = {
             "user_id": user_id,
             "message": message,
@@ -36,60 +87,31 @@ class StreamChatClient:
         
         try:
             # 发送流式请求
-            response = self.session.post(
-                url, 
-                json=data, 
-                headers={"Content-Type": "application/json"},
-                stream=True,
-                timeout=60
-            )
-            
-            if response.status_code != 200:
-                print(f"❌ 请求失败: {response.status_code} - {response.text}")
-                return
-            
-            print("📡 开始接收流式数据...\n")
+            with self.session.stream("POST", "/api/chat/message", json=data) as response:
+                if response.status_code != 200:
+                    response.read()
+                    print(f"❌ 请求失败: {response.status_code} - {response.text}")
+                    return
+                
+                print("📡 开始接收流式数据...\n")
             
-            # 解析流式响应
-            metadata = None
-            content_buffer = []
+                # 解析流式响应
+                handlers = _PRETTY_HANDLERS if self.pretty else _HANDLERS
+                content_buffer = []
             
-            for line in response.iter_lines(decode_unicode=True):
-                if line.startswith("data: "):
-                    data_str = line[6:]  # 移除 "data: " 前缀
-                    
-                    try:
-                        data = json.loads(data_str)
+                for line in _iter_lines(response):
+                    if line.startswith(b"data: "):
+                        try:
+                            # 移除 "data: " 前缀后直接交给orjson解析（无需先解码为str）
+                            data = orjson.loads(line[6:])
+                        except orjson.JSONDecodeError as e:
+                            print(f"⚠️ JSON解析错误: {e}")
+                            continue
                         
-                        if data["type"] == "metadata":
-                            metadata = data
-                            print(f"📋 元数据信息:")
-                            print(f"   用户ID: {data['user_id']}")
-                            print(f"   会话ID: {data['session_id']}")
-                            print(f"   使用记忆: {data['memories_used']}")
-                            print(f"   时间戳: {data['timestamp']}")
-                            print("\n🤖 AI回复:")
-                            
-                        elif data["type"] == "content":
-                            content = data["content"]
-                            content_buffer.append(content)
-                            # 实时打印内容，不换行，模拟打字机效果
-                            for char in content:
-                                print(char, end='', flush=True)
-                                time.sleep(0.02)  # 添加微小延迟，增强视觉效果
-                            
-                        elif data["type"] == "done":
-                            print("\n")
-                            print("-" * 50)
-                            print(f"✅ 流式输出完成!")
-                            print(f"📝 完整回复: {''.join(content_buffer)}")
+                        if handlers.get(data["type"], _noop)(data, content_buffer) is _DONE:
                             break
-                            
-                    except json.JSONDecodeError as e:
-                        print(f"⚠️ JSON解析错误: {e}")
-                        continue
                         
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             print(f"❌ 网络请求错误: {e}")
         except KeyboardInterrupt:
             print(f"\n\n⏹️ 用户中断")
@@ -97,7 +119,6 @@ class StreamChatClient:
     def normal_chat(self, user_id: str, message: str, session_id: Optional[str] = None):
         """发送普通对话请求"""
         
-        url = f"{self.base_url}/api/chat/message"
         data = {
             "user_id": user_id,
             "message": message,
@@ -114,12 +135,7 @@ class StreamChatClient:
         print("-" * 50)
         
         try:
-            response = self.session.post(
-                url, 
-                json=data, 
-                headers={"Content-Type": "application/json"},
-                timeout=60
-            )
+            response = self.session.post("/api/chat/message", json=data)
             
             if response.status_code == 200:
                 result = response.json()
@@ -130,11 +146,12 @@ class StreamChatClient:
             else:
                 print(f"❌ 请求失败: {response.status_code} - {response.text}")
                 
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             print(f"❌ 网络请求错误: {e}")
 
 def main():
-    client = StreamChatClient()
+    # --pretty 开启打字机效果；默认直接输出，便于测量真实的流式延迟
+    client = StreamChatClient(pretty="--pretty" in sys.argv[1:])
     
     print("=" * 60)
     print("🚀 Mem0 长记忆对话流式测试脚本")
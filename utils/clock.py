@@ -0,0 +1,16 @@
+import asyncio
+from datetime import datetime
+
+# 缓存的当前时间，由后台任务定期刷新
+_now: datetime = datetime.now()
+
+def now() -> datetime:
+    """获取缓存的当前时间（精度约为刷新间隔），需要精确时间时请直接调用 datetime.now()"""
+    return _now
+
+async def tick(interval: float = 0.1):
+    """后台刷新缓存时间的任务，在应用生命周期内运行"""
+    global _now
+    while True:
+        _now = datetime.now()
+        await asyncio.sleep(interval)